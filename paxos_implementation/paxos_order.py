@@ -33,6 +33,18 @@ learned_values = {}
 
 catalog_host = os.environ.get("CATALOG_HOST", "localhost")
 catalog_port = int(os.environ.get("CATALOG_PORT", "6666"))
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "catalog")
+)
+from shard_map import load_shard_map
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "order")
+)
+from catalog_pool import catalog_pool
+
+shard_map = load_shard_map()  # None unless CATALOG_SHARDS names a shard map
 replica_no = 0
 order_file = "data/orders0.csv"
 server_port = 7777
@@ -82,13 +94,17 @@ def save_order(transaction_num, stock_name, order_type, quantity):
         print(f"Failed to log order: {e}")
 
 
+def catalog_address(request):
+    # with a sharded catalog, the shard owning the stock answers
+    if shard_map is not None and "stock_name" in request:
+        shard = shard_map.shard_for(request["stock_name"])
+        return shard["host"], shard["port"]
+    return catalog_host, catalog_port
+
+
 def ask_catalog(request):
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.connect((catalog_host, catalog_port))
-            sock.sendall(json.dumps(request).encode("utf-8"))
-            response = sock.recv(4096)
-            return json.loads(response.decode("utf-8"))
+        return catalog_pool(*catalog_address(request)).request(request)
     except Exception as e:
         print(f"Failed to talk to catalog: {e}")
         return {
@@ -1,21 +1,89 @@
+import asyncio
 import socket
 import threading
 import json
 import csv
 import os
+import time
+import sys
+import mmap
+import re
+import struct
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from shard_map import load_shard_map
 
 # Variables Initialization
-stock_check = {} # dictionary format: {name: {price, quantity}}
-guardian = threading.RLock()
-catalog_port = 6666
+stock_check = {} # dictionary format: {name: {price, quantity, version}}
+# bumped on every published update; an entry's version is the catalog version
+# that last changed it
+catalog_version = 0
+# updates to a stock are serialized by its lock stripe; striping keeps the lock
+# count fixed however many stocks we list
+lock_stripes = [
+    threading.Lock() for _ in range(int(os.environ.get("CATALOG_LOCK_STRIPES", "256")))
+]
+guardian = threading.RLock()  # serializes publishing and persisting updates
+catalog_port = int(os.environ.get("CATALOG_PORT", "6666"))
+
+# "threaded" runs one thread per connection, "asyncio" serves every connection
+# from a single event loop (also selectable with --asyncio)
+server_mode = os.environ.get("CATALOG_SERVER", "threaded")
+listen_backlog = int(os.environ.get("CATALOG_BACKLOG", "128"))
+# frontend cache that is always invalidated (empty host disables it); other
+# frontends subscribe themselves and are dropped if they stop renewing
+invalidation_host = os.environ.get("INVALIDATION_HOST", "localhost")
+invalidation_port = int(os.environ.get("INVALIDATION_PORT", "5556"))
+invalidation_window = float(os.environ.get("CATALOG_INVALIDATION_WINDOW_MS", "5")) / 1000
+subscriber_ttl = float(os.environ.get("CATALOG_SUBSCRIBER_TTL", "30"))
+# worker threads the asyncio server hands blocking requests (updates) to
+async_workers = int(os.environ.get("CATALOG_WORKERS", "16"))
 
 stock_file = "data/catalog.csv"
 
+# set when this process is one shard of a sharded catalog (--shard=N), see
+# shard_map.py; each shard keeps its own files and only the stocks it owns
+shard_map = None
+shard_id = None
+
+# "dict" keeps a dict per stock, "array" packs the columns into flat arrays
+# (see ArrayStockTable), which is much smaller and faster to load for big
+# catalogs, "mmap" serves straight from a binary snapshot (see MmapStockTable)
+table_mode = os.environ.get("CATALOG_TABLE", "dict")
+snapshot_file = "data/catalog.snap"
+
+# "csv" rewrites the whole catalog file on every trade, "wal" appends one record
+# per trade to a write-ahead log and rewrites the csv in the background
+durability_mode = os.environ.get("CATALOG_DURABILITY", "csv")
+wal_file = "data/catalog.wal"
+checkpoint_interval = float(os.environ.get("CATALOG_CHECKPOINT_SECS", "5"))
+wal_lock = threading.Lock()
+wal_handle = None
+wal_records = 0  # records appended since the last checkpoint
+
+# fsync policy for catalog writes: "none", "every-write" (writers that arrive
+# while an fsync is running share the next one) or "every-N-ms", e.g.
+# "every-10-ms" (a background fsync every N ms covers everything written since).
+# Writes are only acknowledged once their fsync is done.
+fsync_policy = os.environ.get("CATALOG_FSYNC", "none")
+wal_seq = 0  # records appended to the log so far
+durable_seq = 0  # records known to be on disk
+durable_cond = threading.Condition()
+fsync_running = False
+
 
 # Main Function
 def load_stocks():  # labask - 10 different stocks, 100 volume
-    global stock_check
-    if not os.path.exists(stock_file):
+    global stock_check, catalog_version
+    # mmap mode keeps the catalog in the snapshot and the other modes in the
+    # csv, so after switching modes the other file may hold newer trades
+    if table_mode == "mmap" and newer_than(stock_file, snapshot_file):
+        convert_csv_to_snapshot()
+    elif table_mode != "mmap" and newer_than(snapshot_file, stock_file):
+        convert_snapshot_to_csv()
+    if table_mode == "mmap" and os.path.exists(snapshot_file):
+        stock_check = MmapStockTable(snapshot_file)
+    elif not os.path.exists(stock_file):
         stock_check = {
             "GameStart": {"price": 15.99, "quantity": 100},
             "RottenFishCo": {"price": 2.50, "quantity": 100},
@@ -28,9 +96,13 @@ def load_stocks():  # labask - 10 different stocks, 100 volume
             "DogmatixCo": {"price": 20.00, "quantity": 100},
             "LutetiaTech": {"price": 11.00, "quantity": 100},
         }
+        if shard_map is not None:
+            stock_check = {
+                name: details for name, details in stock_check.items() if owns(name)
+            }
         save_stocks()
     else:
-        stock_check = {}
+        stock_check = ArrayStockTable() if table_mode == "array" else {}
         try:
             with open(stock_file, "r") as file:
                 reader = csv.reader(file)
@@ -38,7 +110,15 @@ def load_stocks():  # labask - 10 different stocks, 100 volume
                 for row in reader:
                     if len(row) >= 3:
                         name, price, quantity = row[0], float(row[1]), int(row[2])
-                        stock_check[name] = {"price": price, "quantity": quantity}
+                        version = int(row[3]) if len(row) >= 4 else 0
+                        if table_mode == "array":
+                            stock_check.add(name, price, quantity, version)
+                        else:
+                            stock_check[name] = {
+                                "price": price,
+                                "quantity": quantity,
+                                "version": version,
+                            }
         except Exception as e:
             print(f"Reading failed: {e}")
             stock_check = {
@@ -47,83 +127,790 @@ def load_stocks():  # labask - 10 different stocks, 100 volume
                 "BoarCo": {"price": 7.11, "quantity": 382},
                 "MenhirCo": {"price": 20.00, "quantity": 25},
             }
-    print("Stock catalog loaded:", stock_check)
+    if isinstance(stock_check, dict):
+        for details in stock_check.values():
+            details.setdefault("version", 0)
+        if table_mode == "array":
+            defaults, stock_check = stock_check, ArrayStockTable()
+            stock_check.update(defaults)
+        elif table_mode == "mmap":
+            write_snapshot(snapshot_file, stock_check.items())
+            stock_check = MmapStockTable(snapshot_file)
+    catalog_version = max_version(stock_check)
+    if replay_wal() and durability_mode != "wal":
+        # folding the log back into the csv so it isn't replayed twice
+        if save_stocks():
+            remove_wal_files()
+    if len(stock_check) <= 20:
+        print("Stock catalog loaded:", dict(stock_check.items()))
+    else:
+        print(f"Stock catalog loaded: {len(stock_check)} stocks")
+
+
+def owns(stock_name):
+    return shard_map is None or shard_map.shard_for(stock_name)["id"] == shard_id
+
+
+def setup_shard(shard):
+    global shard_map, shard_id, catalog_port, stock_file, wal_file, snapshot_file
+    shard_map = load_shard_map()
+    if shard_map is None:
+        raise SystemExit("--shard needs CATALOG_SHARDS set to the shard map file")
+    shard_id = shard
+    catalog_port = shard_map.by_id[shard]["port"]
+    base_file = stock_file
+    stock_file = f"data/catalog{shard}.csv"
+    wal_file = f"data/catalog{shard}.wal"
+    snapshot_file = f"data/catalog{shard}.snap"
+    fresh = not any(os.path.exists(path) for path in (stock_file, wal_file, snapshot_file))
+    if fresh and os.path.exists(base_file):
+        # first start of this shard: take our share of the unsharded catalog
+        with open(base_file, "r") as source, open(stock_file, "w", newline="") as target:
+            reader = csv.reader(source)
+            writer = csv.writer(target)
+            writer.writerow(next(reader))
+            writer.writerows(row for row in reader if row and owns(row[0]))
+    print(f"Running as catalog shard {shard} of {len(shard_map.shards)}")
+
+
+def max_version(table):
+    if isinstance(table, dict):
+        return max((details["version"] for details in table.values()), default=0)
+    return table.max_version()
+
+
+def copy_table(table):
+    # a copy of the catalog that stays put while trades go on; entries are
+    # replaced rather than edited, so a dict can share them
+    if isinstance(table, dict):
+        return dict(table)
+    return table.copy()
+
+
+class ArrayStockTable:
+    # Stock table for large symbol universes: a name -> row hash plus one flat
+    # array per column, a few dozen bytes per stock instead of a dict each.
+    # It answers the same dict calls the rest of the catalog makes, handing out
+    # a fresh dict per read. Every row has a sequence number that is odd while
+    # the row is being written, so lock-free readers retry instead of seeing a
+    # half-updated row.
+    def __init__(self):
+        self.index = {}
+        self.names = []
+        self.prices = array("d")
+        self.quantities = array("q")
+        self.versions = array("q")
+        self.seqs = array("q")
+
+    def add(self, name, price, quantity, version=0):
+        if name in self.index:
+            self[name] = {"price": price, "quantity": quantity, "version": version}
+            return
+        self.names.append(name)
+        self.prices.append(price)
+        self.quantities.append(quantity)
+        self.versions.append(version)
+        self.seqs.append(0)
+        self.index[name] = len(self.names) - 1  # publish the row last
+
+    def read_row(self, row):
+        while True:
+            seq = self.seqs[row]
+            if seq & 1:
+                time.sleep(0)  # writer is mid-update, let it finish
+                continue
+            details = {
+                "price": self.prices[row],
+                "quantity": self.quantities[row],
+                "version": self.versions[row],
+            }
+            if self.seqs[row] == seq:
+                return details
+
+    def get(self, name, default=None):
+        row = self.index.get(name)
+        if row is None:
+            return default
+        return self.read_row(row)
+
+    def __getitem__(self, name):
+        details = self.get(name)
+        if details is None:
+            raise KeyError(name)
+        return details
+
+    def __setitem__(self, name, details):
+        row = self.index.get(name)
+        if row is None:
+            self.add(name, details["price"], details["quantity"], details.get("version", 0))
+            return
+        # writers to a row are already serialized by the catalog's locks
+        self.seqs[row] += 1
+        self.prices[row] = details["price"]
+        self.quantities[row] = details["quantity"]
+        self.versions[row] = details.get("version", 0)
+        self.seqs[row] += 1
+
+    def update(self, changes):
+        for name, details in changes.items():
+            self[name] = details
+
+    def max_version(self):
+        return max(self.versions, default=0)
+
+    def copy(self):
+        # whole-array copies rather than a dict per row
+        count = len(self.index)
+        table = ArrayStockTable()
+        table.index = dict(self.index)
+        table.names = self.names[:count]
+        table.prices = self.prices[:count]
+        table.quantities = self.quantities[:count]
+        table.versions = self.versions[:count]
+        table.seqs = array("q", bytes(8 * count))
+        return table
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.names[: len(self.index)])
+
+    def items(self):
+        return [(name, self.read_row(row)) for row, name in enumerate(list(self))]
+
+    def values(self):
+        return [details for name, details in self.items()]
+
+
+# Binary snapshot: a header (magic, stock count, highest version, name width)
+# followed by fixed-width records sorted by name, so a stock can be found by
+# binary search straight out of the mapped file.
+SNAPSHOT_MAGIC = b"CATSNAP1"
+snapshot_header = struct.Struct("<8sQQI4x")
+snapshot_fields = struct.Struct("<dqq")  # price, quantity, version
+
+
+def write_snapshot(path, items):
+    rows = sorted((name.encode("utf-8"), details) for name, details in items)
+    # names are stored padded to the longest one, rounded up to 8 bytes
+    width = max((len(name) for name, details in rows), default=8)
+    width = (width + 7) // 8 * 8
+    version = max((details.get("version", 0) for name, details in rows), default=0)
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    temp_file = path + ".tmp"
+    with open(temp_file, "wb") as file:
+        file.write(snapshot_header.pack(SNAPSHOT_MAGIC, len(rows), version, width))
+        for name, details in rows:
+            file.write(name.ljust(width, b"\0"))
+            file.write(
+                snapshot_fields.pack(
+                    details["price"], details["quantity"], details.get("version", 0)
+                )
+            )
+    fsync_replace(temp_file, path)
+
+
+def file_version(path):
+    # highest version in a catalog csv or snapshot
+    if path.endswith(".snap"):
+        with open(path, "rb") as file:
+            return snapshot_header.unpack(file.read(snapshot_header.size))[2]
+    with open(path, "r") as file:
+        reader = csv.reader(file)
+        next(reader)
+        return max((int(row[3]) for row in reader if len(row) >= 4), default=0)
+
+
+def newer_than(path, other):
+    # whether path holds updates other is missing; the mtimes rule out most
+    # cases without reading either file
+    if not os.path.exists(path):
+        return False
+    if not os.path.exists(other):
+        return True
+    if os.path.getmtime(path) <= os.path.getmtime(other):
+        return False
+    try:
+        return file_version(path) > file_version(other)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Could not compare {path} with {other}: {e}")
+        return False
+
+
+def convert_snapshot_to_csv():
+    table = MmapStockTable(snapshot_file)
+    rows = {name: dict(details) for name, details in table.items()}
+    table.close()
+    save_stocks(rows)
+    print(f"Converted {len(rows)} stocks from {snapshot_file} to {stock_file}")
+
+
+def convert_csv_to_snapshot(csv_path=None, snapshot_path=None):
+    csv_path = csv_path or stock_file
+    snapshot_path = snapshot_path or snapshot_file
+    with open(csv_path, "r") as file:
+        reader = csv.reader(file)
+        next(reader)
+        items = [
+            (
+                row[0],
+                {
+                    "price": float(row[1]),
+                    "quantity": int(row[2]),
+                    "version": int(row[3]) if len(row) >= 4 else 0,
+                },
+            )
+            for row in reader
+            if len(row) >= 3
+        ]
+    write_snapshot(snapshot_path, items)
+    print(f"Converted {len(items)} stocks from {csv_path} to {snapshot_path}")
 
 
-def save_stocks(): # to store details in csv file
+class MmapStockTable:
+    # Stock table served straight from a memory-mapped snapshot, so startup
+    # cost doesn't depend on the number of stocks. Rows are only unpacked when
+    # first read; unpacked and updated entries live in an overlay dict that
+    # takes precedence over the (read-only) file.
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.file_version, self.width = snapshot_header.unpack_from(
+            self.map, 0
+        )
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        self.row_size = self.width + snapshot_fields.size
+        self.overlay = {}
+        self.added = []  # stocks that aren't in the file at all
+
+    def row_name(self, row):
+        offset = snapshot_header.size + row * self.row_size
+        return self.map[offset : offset + self.width]
+
+    def find_row(self, name):
+        key = name.encode("utf-8")
+        if len(key) > self.width:
+            return -1
+        key = key.ljust(self.width, b"\0")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.row_name(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.row_name(low) == key:
+            return low
+        return -1
+
+    def read_row(self, row):
+        offset = snapshot_header.size + row * self.row_size + self.width
+        price, quantity, version = snapshot_fields.unpack_from(self.map, offset)
+        return {"price": price, "quantity": quantity, "version": version}
+
+    def get(self, name, default=None):
+        details = self.overlay.get(name)
+        if details is not None:
+            return details
+        row = self.find_row(name)
+        if row < 0:
+            return default
+        # a concurrent update may beat us to the overlay; theirs wins
+        return self.overlay.setdefault(name, self.read_row(row))
+
+    def __getitem__(self, name):
+        details = self.get(name)
+        if details is None:
+            raise KeyError(name)
+        return details
+
+    def __setitem__(self, name, details):
+        if name not in self.overlay and self.find_row(name) < 0:
+            self.added.append(name)
+        self.overlay[name] = details
+
+    def update(self, changes):
+        for name, details in changes.items():
+            self[name] = details
+
+    def max_version(self):
+        return max(
+            [self.file_version] + [d["version"] for d in list(self.overlay.values())]
+        )
+
+    def copy(self):
+        # the mapped file never changes, so only the overlay is copied
+        table = MmapStockTable.__new__(MmapStockTable)
+        table.__dict__.update(self.__dict__)
+        table.overlay = dict(self.overlay)
+        table.added = list(self.added)
+        return table
+
+    def __contains__(self, name):
+        return name in self.overlay or self.find_row(name) >= 0
+
+    def __len__(self):
+        return self.count + len(self.added)
+
+    def __iter__(self):
+        for row in range(self.count):
+            yield self.row_name(row).rstrip(b"\0").decode("utf-8")
+        yield from list(self.added)
+
+    def items(self):
+        items = []
+        for row in range(self.count):
+            name = self.row_name(row).rstrip(b"\0").decode("utf-8")
+            details = self.overlay.get(name)
+            items.append((name, details if details is not None else self.read_row(row)))
+        items.extend((name, self.overlay[name]) for name in list(self.added))
+        return items
+
+    def values(self):
+        return [details for name, details in self.items()]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def save_stocks(snapshot=None): # to store details in csv file
+    if snapshot is None:
+        snapshot = stock_check
+    if table_mode == "mmap":
+        # the binary snapshot replaces the csv as the catalog's file
+        try:
+            write_snapshot(snapshot_file, snapshot.items())
+            return True
+        except Exception as e:
+            print(f"Failed to write stocks: {e}")
+            return False
     try:
         if not os.path.exists("data"):
             os.makedirs("data")
-        with open(stock_file, "w", newline="") as file:
+        # write to a temp file first so a crash never leaves half a catalog behind
+        temp_file = stock_file + ".tmp"
+        with open(temp_file, "w", newline="") as file:
             writer = csv.writer(
                 file
             )  # Resource: https://docs.python.org/3/library/csv.html
-            writer.writerow(["name", "price", "quantity"])
-            for name, details in stock_check.items():
-                writer.writerow([name, details["price"], details["quantity"]])
+            writer.writerow(["name", "price", "quantity", "version"])
+            for name, details in snapshot.items():
+                writer.writerow(
+                    [name, details["price"], details["quantity"], details.get("version", 0)]
+                )
+        fsync_replace(temp_file, stock_file)
+        return True
     except Exception as e:
         print(f"Failed to write stocks: {e}")
+        return False
+
+
+# Write-ahead log: one JSON line per update, holding [name, new_quantity,
+# version] entries (logs written before versioning have no version).
+# Records carry the resulting quantity rather than the delta, so replaying a
+# record that already made it into the csv is harmless.
+def fsync_replace(temp_file, path): # move a finished file into place
+    if fsync_policy != "none":
+        with open(temp_file, "rb") as file:
+            os.fsync(file.fileno())
+    os.replace(temp_file, path)
+    if fsync_policy != "none":
+        # the rename itself lives in the directory
+        directory = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+def append_wal(changes): # returns the record's sequence number
+    global wal_handle, wal_records, wal_seq
+    with wal_lock:
+        try:
+            if wal_handle is None:
+                if not os.path.exists("data"):
+                    os.makedirs("data")
+                wal_handle = open(wal_file, "a")
+            wal_handle.write(json.dumps(changes) + "\n")
+            wal_handle.flush()
+            wal_records += 1
+            wal_seq += 1
+            return wal_seq
+        except Exception as e:
+            print(f"Failed to append to catalog log: {e}")
+            return 0
+
+
+def sync_wal(): # fsync everything appended so far, returns the seq it covers
+    with wal_lock:
+        target = wal_seq
+        if wal_handle is None:
+            return target  # checkpoint synced and closed it
+        # dup so a checkpoint can close the handle while we sync
+        fd = os.dup(wal_handle.fileno())
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return target
+
+
+def mark_durable(seq):
+    global durable_seq
+    with durable_cond:
+        if seq > durable_seq:
+            durable_seq = seq
+            durable_cond.notify_all()
+
+
+def wait_durable(seq): # group commit: block until our log record is on disk
+    global fsync_running, durable_seq
+    if fsync_policy == "none" or seq == 0:
+        return
+    with durable_cond:
+        while durable_seq < seq:
+            if fsync_policy == "every-write" and not fsync_running:
+                # become the leader: one fsync for everyone appended so far
+                fsync_running = True
+                durable_cond.release()
+                target = 0
+                try:
+                    target = sync_wal()
+                finally:
+                    durable_cond.acquire()
+                    fsync_running = False
+                    durable_seq = max(durable_seq, target)
+                    durable_cond.notify_all()
+            else:
+                durable_cond.wait()
+
+
+def start_fsync_policy():
+    global fsync_policy
+    interval = re.fullmatch(r"every-(\d+)-ms", fsync_policy)
+    if interval:
+        threading.Thread(
+            target=wal_syncer, args=(int(interval.group(1)) / 1000,), daemon=True
+        ).start()
+    elif fsync_policy not in ("none", "every-write"):
+        print(f"Unknown CATALOG_FSYNC policy {fsync_policy!r}, not syncing")
+        fsync_policy = "none"
+
+
+def wal_syncer(interval): # fsync on a timer for the every-N-ms policy
+    while True:
+        time.sleep(interval)
+        try:
+            if durable_seq < wal_seq:
+                mark_durable(sync_wal())
+        except Exception as e:
+            print(f"Catalog log fsync failed: {e}")
+
+
+def replay_wal():
+    global catalog_version
+    replayed = 0
+    # the rotated log from an unfinished checkpoint is older than the live one
+    for path in (wal_file + ".old", wal_file):
+        if not os.path.exists(path):
+            continue
+        good = 0  # bytes of whole records
+        with open(path, "rb") as file:
+            for line in file:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("record without its newline")
+                    changes = json.loads(line)
+                except ValueError:
+                    break  # torn write at the tail, nothing valid after it
+                good += len(line)
+                for change in changes:
+                    name, quantity = change[0], change[1]
+                    if name in stock_check:
+                        version = change[2] if len(change) > 2 else catalog_version
+                        stock_check[name] = {
+                            "price": stock_check[name]["price"],
+                            "quantity": quantity,
+                            "version": version,
+                        }
+                        catalog_version = max(catalog_version, version)
+                replayed += 1
+        if good < os.path.getsize(path):
+            # the next record appended would be glued to the torn one
+            print(f"Truncating torn catalog log record at {path}:{good}")
+            os.truncate(path, good)
+    if replayed:
+        print(f"Replayed {replayed} catalog log records")
+    return replayed
+
+
+def remove_wal_files():
+    for path in (wal_file + ".old", wal_file):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def checkpoint_stocks():
+    global wal_handle, wal_records
+    with guardian, wal_lock:
+        if wal_records == 0:
+            return
+        # just a copy under the locks; the rows are written out after
+        snapshot = copy_table(stock_check)
+        if wal_handle is not None:
+            if fsync_policy != "none":
+                os.fsync(wal_handle.fileno())
+            wal_handle.close()
+            wal_handle = None
+            mark_durable(wal_seq)
+        # if an earlier checkpoint failed its log is still around; keep it and
+        # leave the live log in place, replay is idempotent either way
+        if not os.path.exists(wal_file + ".old"):
+            os.replace(wal_file, wal_file + ".old")
+        wal_records = 0
+    if save_stocks(snapshot):
+        os.remove(wal_file + ".old")
+
+
+def checkpointer():
+    while True:
+        time.sleep(checkpoint_interval)
+        try:
+            checkpoint_stocks()
+        except Exception as e:
+            print(f"Catalog checkpoint failed: {e}")
 
 
 def find_stock(stock_name): #looking up stock details
-    with guardian:
-        if stock_name in stock_check:
-            return {
-                "status": "success",
-                "data": {
-                    "name": stock_name,
-                    "price": stock_check[stock_name]["price"],
-                    "quantity": stock_check[stock_name]["quantity"],
-                },
-            }
+    # entries are replaced rather than edited, so a single read is a consistent
+    # snapshot and lookups never wait behind trades
+    details = stock_check.get(stock_name)
+    if details is not None:
+        return {
+            "status": "success",
+            "data": {
+                "name": stock_name,
+                "price": details["price"],
+                "quantity": details["quantity"],
+                "version": details["version"],
+            },
+        }
+    else:
+        return {
+            "status": "error",
+            "error": {"code": 404, "message": "stock not found"},
+        }
+
+
+def find_stocks(stock_names): # looking up several stocks in one go
+    # holding every requested stock's lock gives one consistent view of the
+    # batch; see lock_stocks
+    known = set(name for name in stock_names if name in stock_check)
+    locks = lock_stocks(known)
+    try:
+        entries = {name: stock_check[name] for name in known}
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+    found = []
+    errors = {}
+    for name in stock_names:
+        if name in entries:
+            found.append(
+                {
+                    "name": name,
+                    "price": entries[name]["price"],
+                    "quantity": entries[name]["quantity"],
+                    "version": entries[name]["version"],
+                }
+            )
         else:
-            return {
-                "status": "error",
-                "error": {"code": 404, "message": "stock not found"},
-            }
+            errors[name] = {"code": 404, "message": "stock not found"}
+    return {"status": "success", "data": found, "errors": errors}
+
+
+def stock_lock(stock_name):
+    return lock_stripes[hash(stock_name) % len(lock_stripes)]
+
+
+def lock_stocks(stock_names): # acquire the stripes covering several stocks
+    # always in stripe order, so overlapping batches can't deadlock
+    stripes = sorted(set(hash(name) % len(lock_stripes) for name in stock_names))
+    locks = [lock_stripes[stripe] for stripe in stripes]
+    for lock in locks:
+        lock.acquire()
+    return locks
 
 
 def change_quantity(stock_name, qty_change): # to update stock volume
-    with guardian:
-        if stock_name not in stock_check:
-            return {
-                "status": "error",
-                "error": {"code": 404, "message": "stock not found"},
-            }
-        current_qty = stock_check[stock_name]["quantity"]
-        new_qty = current_qty + qty_change
+    if stock_name not in stock_check:
+        return {
+            "status": "error",
+            "error": {"code": 404, "message": "stock not found"},
+        }
+    with stock_lock(stock_name):
+        details = stock_check[stock_name]
+        new_qty = details["quantity"] + qty_change
         if new_qty < 0:
             return {
                 "status": "error",
                 "error": {"code": 400, "message": "insufficient quantity"},
             }
-        stock_check[stock_name]["quantity"] = new_qty
-        save_stocks()
-        send_invalidation(stock_name)  #calling invalidate function
+        version, seq = publish_changes(
+            {stock_name: {"price": details["price"], "quantity": new_qty}}
+        )
+    wait_durable(seq)
+    send_invalidation(stock_name)  #calling invalidate function
+    return {
+        "status": "success",
+        "data": {
+            "name": stock_name,
+            "price": details["price"],
+            "quantity": new_qty,
+            "version": version,
+        },
+    }
+
+
+def change_quantities(legs): # basket update: every leg applies or none does
+    totals = {}
+    for leg in legs:
+        name = leg["stock_name"]
+        totals[name] = totals.get(name, 0) + leg["quantity_change"]
+    if not totals:
         return {
-            "status": "success",
-            "data": {
-                "name": stock_name,
-                "price": stock_check[stock_name]["price"],
-                "quantity": new_qty,
-            },
+            "status": "error",
+            "error": {"code": 400, "message": "no legs given"},
         }
+    for name in totals:
+        if name not in stock_check:
+            return {
+                "status": "error",
+                "error": {"code": 404, "message": "stock not found", "stock_name": name},
+            }
+    locks = lock_stocks(totals)
+    try:
+        updated = {}
+        for name, qty_change in totals.items():
+            details = stock_check[name]
+            new_qty = details["quantity"] + qty_change
+            if new_qty < 0:
+                return {
+                    "status": "error",
+                    "error": {
+                        "code": 400,
+                        "message": "insufficient quantity",
+                        "stock_name": name,
+                    },
+                }
+            updated[name] = {"price": details["price"], "quantity": new_qty}
+        # one version, one persisted record and one invalidation for the basket
+        version, seq = publish_changes(updated)
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+    wait_durable(seq)
+    send_invalidations(list(updated))
+    return {
+        "status": "success",
+        "version": version,
+        "data": [
+            {
+                "name": name,
+                "price": details["price"],
+                "quantity": details["quantity"],
+                "version": version,
+            }
+            for name, details in updated.items()
+        ],
+    }
+
+
+def publish_changes(changes): # swap in new entries and persist them
+    global catalog_version
+    with guardian:
+        version = catalog_version + 1
+        for details in changes.values():
+            details["version"] = version
+        stock_check.update(changes)
+        # only bump the global version once the entries are visible, so anyone
+        # who reads version V can already see every change up to V
+        catalog_version = version
+        seq = 0
+        if durability_mode == "wal":
+            seq = append_wal(
+                [[name, d["quantity"], d["version"]] for name, d in changes.items()]
+            )
+        else:
+            save_stocks()
+    # callers wait_durable(seq) once they've dropped their locks, so writers
+    # can pile up behind one fsync
+    return version, seq
+
+
+def changes_since(version): # entries modified after the given catalog version
+    current = catalog_version  # read first, see publish_changes
+    changed = [
+        {
+            "name": name,
+            "price": details["price"],
+            "quantity": details["quantity"],
+            "version": details["version"],
+        }
+        for name, details in list(stock_check.items())
+        if details["version"] > version
+    ]
+    return {"status": "success", "version": current, "data": changed}
+
+
+def recv_json(sock): # batched requests can be bigger than a single recv
+    data = b""
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            if data:
+                raise ConnectionError("connection closed mid-message")
+            return None
+        data += chunk
+        try:
+            return json.loads(data.decode("utf-8"))
+        except ValueError:
+            continue  # message not complete yet
+
+
+def dispatch(request): # shared by the threaded and asyncio servers
+    response = {}
+    if request["action"] == "lookup":
+        response = find_stock(request["stock_name"])
+    elif request["action"] == "lookup_many":
+        response = find_stocks(request["stock_names"])
+    elif request["action"] == "update":
+        response = change_quantity(
+            request["stock_name"], request["quantity_change"]
+        )
+    elif request["action"] == "update_many":
+        response = change_quantities(request["legs"])
+    elif request["action"] == "changes_since":
+        response = changes_since(request["version"])
+    elif request["action"] == "subscribe":
+        response = subscribe(request["host"], request["port"])
+    return response
 
 
 def handle_client(client_socket): # to deal with JSON requests from clients
     try:
         while True:
-            data = client_socket.recv(4096)
-            if not data:
+            request = recv_json(client_socket)
+            if request is None:
                 break
-            request = json.loads(data.decode("utf-8"))
-            response = {}
-            if request["action"] == "lookup":
-                response = find_stock(request["stock_name"])
-            elif request["action"] == "update":
-                response = change_quantity(
-                    request["stock_name"], request["quantity_change"]
-                )
+            response = dispatch(request)
             client_socket.sendall(json.dumps(response).encode("utf-8"))
     except Exception as e:
         print(f"Error handling client: {e}")
@@ -131,29 +918,204 @@ def handle_client(client_socket): # to deal with JSON requests from clients
         client_socket.close()
 
 
+async def handle_client_async(reader, writer): # same protocol, no thread per client
+    loop = asyncio.get_running_loop()
+    data = b""
+    try:
+        while True:
+            chunk = await reader.read(4096)
+            if not chunk:
+                break
+            data += chunk
+            try:
+                request = json.loads(data.decode("utf-8"))
+            except ValueError:
+                continue  # message not complete yet
+            data = b""
+            if request["action"] == "lookup":
+                # lock-free, safe to answer straight from the event loop
+                response = dispatch(request)
+            else:
+                # anything that can wait on a lock or the disk goes to the pool
+                response = await loop.run_in_executor(None, dispatch, request)
+            writer.write(json.dumps(response).encode("utf-8"))
+            await writer.drain()
+    except Exception as e:
+        print(f"Error handling client: {e}")
+    finally:
+        writer.close()
+
+
+def start_async_server(host):
+    async def serve():
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=async_workers))
+        server = await asyncio.start_server(
+            handle_client_async,
+            host,
+            catalog_port,
+            backlog=listen_backlog,
+            reuse_address=True,
+        )
+        print(f"Catalog service (asyncio) running on {host}:{catalog_port}")
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("Shutting down the catalog service...")
+
+
 # AI: ChatGPT4o
 # prompt: my cache doesnt get updated upon a trade. Give me some starter code for my catalog service to invalidate cache entries that have been updated. i want it in basic python and sockets, not flask.
 def send_invalidation(stock_name):
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.connect(("localhost", 5556))
-            message = json.dumps({"invalidate": stock_name})
-            sock.sendall(message.encode("utf-8"))
-    except Exception as e:
-        print(f"Invalidation send failed: {e}")
+    send_invalidations([stock_name])
+
+
+def send_invalidations(stock_names):
+    with subscribers_lock:
+        targets = list(subscribers.values())
+    # every subscriber has its own sender thread, so the fan-out is parallel
+    for sender in targets:
+        sender.queue(stock_names)
 
 
 # end prompt: my cache doesnt get updated upon a trade. Give me some starter code for my catalog service to invalidate cache entries that have been updated. i want it in basic python and sockets, not flask.
 
 
+class InvalidationSender:
+    # Ships invalidations to one frontend from a background thread so trades
+    # never wait on the frontend. Names queued within one window go out as a
+    # single frame, so a hot stock traded many times is only invalidated once.
+    def __init__(self, host, port, static=False):
+        self.host = host
+        self.port = port
+        self.static = static  # configured rather than subscribed, never expires
+        self.last_seen = time.time()  # last subscribe from the frontend
+        self.failures = 0  # consecutive failed sends
+        # set when a send failed: the frontend may have served stale entries
+        # meanwhile, so its next subscribe is answered as if it were new
+        self.missed = False
+        self.stopped = False
+        self.pending = set()
+        self.ready = threading.Condition()
+        self.sock = None
+        self.reader = None
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def queue(self, stock_names):
+        with self.ready:
+            self.pending.update(stock_names)
+            self.ready.notify()
+
+    def stop(self):
+        with self.ready:
+            self.stopped = True
+            self.ready.notify()
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not self.pending and not self.stopped:
+                    self.ready.wait()
+                if self.stopped:
+                    break
+            time.sleep(invalidation_window)  # let repeated updates pile up
+            with self.ready:
+                batch = sorted(self.pending)
+                self.pending.clear()
+            if self.send(batch):
+                self.failures = 0
+            else:
+                # keep the names for when the frontend is back, and back off
+                self.failures += 1
+                self.missed = True
+                with self.ready:
+                    self.pending.update(batch)
+                time.sleep(min(0.1 * 2 ** self.failures, 5))
+        self.close()
+
+    def send(self, batch):
+        message = json.dumps({"invalidate": batch}) + "\n"
+        # a connection the frontend dropped only shows up on use, so retry once
+        # on a fresh one before giving up
+        for attempt in range(2):
+            try:
+                if self.sock is None:
+                    self.sock = socket.create_connection((self.host, self.port), timeout=2)
+                    self.reader = self.sock.makefile("r")
+                self.sock.sendall(message.encode("utf-8"))
+                if self.reader.readline().strip() == "ok":
+                    return True
+                raise ConnectionError("no acknowledgement")
+            except Exception as e:
+                self.close()
+                error = e
+        print(f"Invalidation send to {self.host}:{self.port} failed: {error}")
+        return False
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.reader = None
+
+
+subscribers = {}  # (host, port) -> InvalidationSender
+subscribers_lock = threading.Lock()
+
+
+def subscribe(host, port, static=False): # frontends call this periodically
+    key = (host, int(port))
+    with subscribers_lock:
+        sender = subscribers.get(key)
+        new = sender is None
+        if new:
+            sender = InvalidationSender(host, int(port), static)
+            subscribers[key] = sender
+            print(f"Invalidation subscriber added: {host}:{port}")
+        elif sender.missed:
+            new = True
+            sender.missed = False
+        sender.last_seen = time.time()
+    # a new subscriber, or one we failed to reach, may have missed
+    # invalidations; it can catch up with changes_since
+    return {"status": "success", "new": new, "version": catalog_version}
+
+
+def reap_subscribers(): # drop frontends that stopped renewing
+    while True:
+        time.sleep(subscriber_ttl / 3)
+        now = time.time()
+        with subscribers_lock:
+            for key, sender in list(subscribers.items()):
+                if not sender.static and now - sender.last_seen > subscriber_ttl:
+                    del subscribers[key]
+                    sender.stop()
+                    print(
+                        f"Invalidation subscriber expired: {key[0]}:{key[1]} "
+                        f"({sender.failures} failed sends)"
+                    )
+
+
 # driver code
 def start_server():
     load_stocks()
+    if durability_mode == "wal":
+        threading.Thread(target=checkpointer, daemon=True).start()
+    start_fsync_policy()
+    if invalidation_host:
+        subscribe(invalidation_host, invalidation_port, static=True)
+    threading.Thread(target=reap_subscribers, daemon=True).start()
+    host = "0.0.0.0"
+    if server_mode == "asyncio":
+        start_async_server(host)
+        return
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    host = "0.0.0.0"
     server.bind((host, catalog_port))
-    server.listen(10) # # of connections 
+    server.listen(listen_backlog) # # of pending connections
     print(f"Catalog service running on {host}:{catalog_port}")
     try:
         while True:
@@ -170,4 +1132,12 @@ def start_server():
 
 # invoke driver code start
 if __name__ == "__main__":
+    for arg in sys.argv:
+        if arg.lower() == "--asyncio":
+            server_mode = "asyncio"
+        elif arg.startswith("--shard="):
+            setup_shard(int(arg.split("=", 1)[1]))
+    if "--convert-snapshot" in sys.argv:
+        convert_csv_to_snapshot()
+        sys.exit(0)
     start_server()
\ No newline at end of file
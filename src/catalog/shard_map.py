@@ -0,0 +1,48 @@
+import bisect
+import hashlib
+import json
+import os
+
+# Consistent-hash routing of stock names to catalog shards. The shard map is a
+# JSON list like orders.json ([{"id": 0, "host": "localhost", "port": 6666}, ...])
+# and is shared by the catalog shards, the frontend and the order service.
+# Leave CATALOG_SHARDS unset to run a single unsharded catalog.
+
+VIRTUAL_NODES = 64  # ring points per shard, evens out the hash ranges
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class ShardMap:
+    def __init__(self, shards):
+        self.shards = sorted(shards, key=lambda shard: shard["id"])
+        ring = sorted(
+            (ring_hash(f"{shard['id']}#{point}"), shard["id"])
+            for shard in self.shards
+            for point in range(VIRTUAL_NODES)
+        )
+        self.points = [point for point, shard_id in ring]
+        self.owners = [shard_id for point, shard_id in ring]
+        self.by_id = {shard["id"]: shard for shard in self.shards}
+
+    def shard_for(self, stock_name):
+        # first ring point clockwise of the name's hash owns it
+        slot = bisect.bisect(self.points, ring_hash(stock_name)) % len(self.points)
+        return self.by_id[self.owners[slot]]
+
+    def group(self, stock_names):
+        # {shard id: [names it owns]}, keeping the caller's order
+        groups = {}
+        for name in stock_names:
+            groups.setdefault(self.shard_for(name)["id"], []).append(name)
+        return groups
+
+
+def load_shard_map(path=None):
+    path = path or os.environ.get("CATALOG_SHARDS")
+    if not path:
+        return None
+    with open(path, "r") as f:
+        return ShardMap(json.load(f))
@@ -0,0 +1,26 @@
+import threading
+import time
+
+# Timing shared by catalog_benchmark.py and order_benchmark.py. Starting many
+# threads can take longer than the measurement itself, so workers only begin
+# counting once every one of them is running, and rates are taken over the time
+# actually measured rather than the nominal duration.
+
+
+def run_timed(workers, duration):
+    # run each worker(start, stop) on its own thread; a worker waits on the
+    # start barrier, then counts operations until stop is set. Returns the
+    # seconds between releasing the barrier and setting stop.
+    start = threading.Barrier(len(workers) + 1)
+    stop = threading.Event()
+    threads = [threading.Thread(target=worker, args=(start, stop)) for worker in workers]
+    for t in threads:
+        t.start()
+    start.wait()
+    began = time.perf_counter()
+    time.sleep(duration)
+    stop.set()
+    elapsed = time.perf_counter() - began
+    for t in threads:
+        t.join()
+    return elapsed
@@ -0,0 +1,311 @@
+# Catalog service micro-benchmarks.
+#
+# Usage: python catalog_benchmark.py [locks|connections|table|fsync|shards]
+#
+# Every benchmark runs against a throwaway copy of the catalog in a temp
+# directory, so the real data/catalog.csv is never touched.
+import asyncio
+import contextlib
+import csv
+import functools
+import io
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "catalog")
+)
+
+import catalog
+from shard_map import ShardMap
+from bench_harness import run_timed
+
+DURATION = float(os.environ.get("BENCH_SECONDS", "2"))
+CATALOG_SCRIPT = os.path.abspath(catalog.__file__)
+
+
+def start_catalog(port, env=None, args=()):
+    # run a real catalog process out of the current (temp) directory
+    proc_env = dict(os.environ, CATALOG_PORT=str(port), **(env or {}))
+    proc = subprocess.Popen(
+        [sys.executable, CATALOG_SCRIPT, *args],
+        env=proc_env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", port), timeout=0.1).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"catalog on port {port} did not start")
+
+
+def thread_count(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("Threads:"):
+                return int(line.split()[1])
+    return -1
+
+
+def bench_locks():
+    # lookups/sec with a varying number of reader threads while two writer
+    # threads keep trading the same stocks
+    thread_counts = [1, 2, 4, 8, 16]
+    writer_count = 2
+    catalog.send_invalidation = lambda stock_name: None  # no frontend here
+    catalog.load_stocks()
+    names = list(catalog.stock_check)
+
+    print(f"{'readers':>8} {'lookups/sec':>14} {'updates/sec':>14}")
+    for readers in thread_counts:
+        lookups = [0] * readers
+        updates = [0] * writer_count
+
+        def reader(slot, start, stop):
+            i = slot
+            start.wait()
+            while not stop.is_set():
+                catalog.find_stock(names[i % len(names)])
+                lookups[slot] += 1
+                i += 1
+
+        def writer(slot, start, stop):
+            i = slot
+            start.wait()
+            while not stop.is_set():
+                # buy then sell back so quantities never run out
+                catalog.change_quantity(names[i % len(names)], -1)
+                catalog.change_quantity(names[i % len(names)], 1)
+                updates[slot] += 2
+                i += 1
+
+        workers = [functools.partial(reader, n) for n in range(readers)]
+        workers += [functools.partial(writer, n) for n in range(writer_count)]
+        elapsed = run_timed(workers, DURATION)
+        print(
+            f"{readers:>8} {sum(lookups) / elapsed:>14.0f} {sum(updates) / elapsed:>14.0f}"
+        )
+
+
+def bench_connections():
+    # lookups/sec and server thread count as the number of open client
+    # connections grows, threaded server vs asyncio server
+    connection_counts = [10, 100, 1000]
+    port = 16666
+
+    async def client(connected, start, stop, counts, slot):
+        reader, writer = await asyncio.open_connection("localhost", port)
+        request = json.dumps({"action": "lookup", "stock_name": "GameStart"}).encode()
+        connected.append(slot)
+        await start.wait()
+        while not stop.is_set():
+            writer.write(request)
+            await writer.drain()
+            await reader.read(4096)
+            counts[slot] += 1
+        writer.close()
+
+    async def run(connections, proc):
+        # only start counting once every connection is open
+        connected = []
+        start = asyncio.Event()
+        stop = asyncio.Event()
+        counts = [0] * connections
+        tasks = [
+            asyncio.create_task(client(connected, start, stop, counts, n))
+            for n in range(connections)
+        ]
+        while len(connected) < connections:
+            if any(task.done() for task in tasks):
+                await asyncio.gather(*tasks)  # raises the connection error
+            await asyncio.sleep(0.01)
+        start.set()
+        began = time.perf_counter()
+        await asyncio.sleep(DURATION)
+        threads = thread_count(proc.pid)
+        stop.set()
+        elapsed = time.perf_counter() - began
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return sum(counts) / elapsed, threads
+
+    print(f"{'mode':>9} {'connections':>12} {'lookups/sec':>12} {'server threads':>15}")
+    for mode in ["threaded", "asyncio"]:
+        for connections in connection_counts:
+            proc = start_catalog(port, env={"CATALOG_SERVER": mode})
+            try:
+                rate, threads = asyncio.run(run(connections, proc))
+            finally:
+                proc.terminate()
+                proc.wait()
+            print(f"{mode:>9} {connections:>12} {rate:>12.0f} {threads:>15}")
+            port += 1
+
+
+def write_catalog(path, count):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "price", "quantity", "version"])
+        for n in range(count):
+            writer.writerow([f"SYM{n:07d}", 10 + n % 500 / 100, 100, 0])
+
+
+def bench_table():
+    # load time and resident size of the catalog table at 10k/100k/1M symbols
+    # (for mmap, the one-off csv conversion is timed separately)
+    sizes = [10_000, 100_000, 1_000_000]
+    os.makedirs("data", exist_ok=True)
+    print(f"{'stocks':>9} {'table':>6} {'load secs':>10} {'table MB':>9} {'bytes/stock':>12}")
+    for count in sizes:
+        write_catalog(catalog.stock_file, count)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            catalog.convert_csv_to_snapshot()
+        print(f"{count:>9} convert csv to snapshot: {time.perf_counter() - start:.2f}s")
+        for mode in ["dict", "array", "mmap"]:
+            catalog.table_mode = mode
+            catalog.stock_check = {}
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                catalog.load_stocks()
+            load_secs = time.perf_counter() - start
+
+            catalog.stock_check = {}
+            tracemalloc.start()
+            with contextlib.redirect_stdout(io.StringIO()):
+                catalog.load_stocks()
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(
+                f"{count:>9} {mode:>6} {load_secs:>10.2f} {size / 2**20:>9.1f} {size / count:>12.0f}"
+            )
+
+
+def bench_fsync():
+    # updates/sec and latency with the write-ahead log under each fsync policy,
+    # for a growing number of concurrent writer threads
+    policies = ["none", "every-write", "every-5-ms"]
+    writer_counts = [1, 4, 16]
+    catalog.send_invalidation = lambda stock_name: None
+    catalog.send_invalidations = lambda stock_names: None
+    catalog.durability_mode = "wal"
+    catalog.checkpoint_interval = 3600  # keep checkpoints out of the numbers
+    with contextlib.redirect_stdout(io.StringIO()):
+        catalog.load_stocks()
+    names = list(catalog.stock_check)
+
+    print(f"{'policy':>12} {'writers':>8} {'updates/sec':>12} {'avg ms':>8}")
+    for policy in policies:
+        catalog.fsync_policy = policy
+        catalog.start_fsync_policy()
+        for writers in writer_counts:
+            updates = [0] * writers
+
+            def writer(slot, start, stop):
+                i = slot
+                start.wait()
+                while not stop.is_set():
+                    catalog.change_quantity(names[i % len(names)], -1)
+                    catalog.change_quantity(names[i % len(names)], 1)
+                    updates[slot] += 2
+                    i += 1
+
+            elapsed = run_timed(
+                [functools.partial(writer, n) for n in range(writers)], DURATION
+            )
+            rate = sum(updates) / elapsed
+            print(f"{policy:>12} {writers:>8} {rate:>12.0f} {writers / rate * 1000:>8.2f}")
+
+
+def shard_client(shards, names, seconds, start, slot):
+    # one client process: keep a connection per shard and trade round-robin,
+    # starting together with the other clients once all are connected
+    shard_map = ShardMap(shards)
+    sockets = {}
+    for shard in shards:
+        sockets[shard["id"]] = socket.create_connection((shard["host"], shard["port"]))
+    start.wait()
+    updates = 0
+    i = slot
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        name = names[i % len(names)]
+        sock = sockets[shard_map.shard_for(name)["id"]]
+        change = -1 if updates % 2 == 0 else 1
+        request = {"action": "update", "stock_name": name, "quantity_change": change}
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        sock.recv(4096)
+        updates += 1
+        i += 1
+    for sock in sockets.values():
+        sock.close()
+    return updates
+
+
+def bench_shards():
+    # updates/sec through the write-ahead log as the catalog is split over
+    # more shard processes; needs at least as many cores as shards + clients
+    shard_counts = [1, 2, 4]
+    clients = 8
+    os.makedirs("data", exist_ok=True)
+    write_catalog(catalog.stock_file, 1000)
+    names = [f"SYM{n:07d}" for n in range(1000)]
+
+    print(f"cores: {os.cpu_count()}")
+    print(f"{'shards':>7} {'clients':>8} {'updates/sec':>12}")
+    for count in shard_counts:
+        shards = [
+            {"id": n, "host": "localhost", "port": 17666 + 10 * count + n}
+            for n in range(count)
+        ]
+        with open("shards.json", "w") as f:
+            json.dump(shards, f)
+        env = {
+            "CATALOG_SHARDS": os.path.abspath("shards.json"),
+            "CATALOG_DURABILITY": "wal",
+            "INVALIDATION_PORT": "1",  # no frontend listening
+        }
+        procs = [
+            start_catalog(shard["port"], env, [f"--shard={shard['id']}"])
+            for shard in shards
+        ]
+        try:
+            with multiprocessing.Manager() as manager, multiprocessing.Pool(clients) as pool:
+                start = manager.Barrier(clients)
+                counts = pool.starmap(
+                    shard_client,
+                    [(shards, names, DURATION, start, n) for n in range(clients)],
+                )
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
+        print(f"{count:>7} {clients:>8} {sum(counts) / DURATION:>12.0f}")
+
+
+benchmarks = {
+    "locks": bench_locks,
+    "connections": bench_connections,
+    "table": bench_table,
+    "fsync": bench_fsync,
+    "shards": bench_shards,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(f"Usage: python catalog_benchmark.py [{'|'.join(benchmarks)}]")
+        sys.exit(1)
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        benchmarks[sys.argv[1]]()
@@ -0,0 +1,167 @@
+# Order service benchmarks.
+#
+# Usage: python order_benchmark.py [consistency|log]
+#
+# Starts its own catalog and three order replicas in a temp directory, so the
+# real data/ directories are never touched. The replicas always listen on
+# 7777-7779, so stop any running order service first. The log benchmark runs
+# the order log writer in-process.
+import functools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(SRC, "order"))
+
+import order
+from bench_harness import run_timed
+
+DURATION = float(os.environ.get("BENCH_SECONDS", "3"))
+CATALOG_PORT = 16666
+REPLICA_PORTS = [7777, 7778, 7779]
+
+
+def wait_for_port(port, proc):
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"service on port {port} did not start")
+
+
+def start_services(env=None):
+    # catalog plus three order replicas, run out of the current (temp) directory
+    proc_env = dict(os.environ, CATALOG_PORT=str(CATALOG_PORT), **(env or {}))
+    proc_env["INVALIDATION_PORT"] = "1"  # no frontend listening
+    with open("orders.json", "w") as f:
+        json.dump([{"id": n, "host": "localhost", "port": port} for n, port in enumerate(REPLICA_PORTS)], f)
+    procs = []
+    command = [sys.executable, os.path.join(SRC, "catalog", "catalog.py")]
+    procs.append(subprocess.Popen(command, env=proc_env, stdout=subprocess.DEVNULL))
+    wait_for_port(CATALOG_PORT, procs[-1])
+    # followers first, so the leader finds them when it starts replicating
+    for replica in reversed(range(len(REPLICA_PORTS))):
+        command = [sys.executable, os.path.join(SRC, "order", "order.py"), str(replica)]
+        procs.append(subprocess.Popen(command, env=proc_env, stdout=subprocess.DEVNULL))
+        wait_for_port(REPLICA_PORTS[replica], procs[-1])
+    return procs
+
+
+def stop_services(procs):
+    for proc in procs:
+        proc.terminate()
+        proc.wait()
+
+
+def trade_client(consistency, latencies, errors, start, stop):
+    sock = socket.create_connection(("localhost", REPLICA_PORTS[0]))
+    start.wait()
+    i = 0
+    while not stop.is_set():
+        request = {
+            "action": "trade",
+            "stock_name": "GameStart",
+            "quantity": 1,
+            # buy then sell back so the stock never runs out
+            "order_type": "buy" if i % 2 == 0 else "sell",
+            "consistency": consistency,
+        }
+        sent = time.perf_counter()
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        response = json.loads(sock.recv(4096).decode("utf-8"))
+        latencies.append(time.perf_counter() - sent)
+        if response["status"] != "success":
+            errors.append(response["error"])
+        i += 1
+    sock.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def bench_consistency():
+    # trade latency and throughput at each consistency level, for a growing
+    # number of concurrent clients (one connection each) on the leader
+    levels = ["async", "quorum", "all"]
+    client_counts = [1, 4, 16]
+    procs = start_services()
+    try:
+        print(f"{'level':>7} {'clients':>8} {'trades/sec':>11} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for level in levels:
+            for clients in client_counts:
+                latencies = []
+                errors = []
+                elapsed = run_timed(
+                    [functools.partial(trade_client, level, latencies, errors)] * clients,
+                    DURATION,
+                )
+                print(
+                    f"{level:>7} {clients:>8} {len(latencies) / elapsed:>11.0f}"
+                    f" {percentile(latencies, 0.5) * 1000:>8.2f}"
+                    f" {percentile(latencies, 0.99) * 1000:>8.2f} {len(errors):>7}"
+                )
+    finally:
+        stop_services(procs)
+
+
+def bench_log():
+    # orders/sec and latency through the log writer, with and without an fsync
+    # per batch, as more trades arrive at once
+    writer_counts = [1, 4, 16]
+    os.makedirs("data", exist_ok=True)
+    print(f"{'storage':>9} {'fsync':>6} {'writers':>8} {'orders/sec':>11} {'avg ms':>8}")
+    for storage in ["csv", "segments"]:
+        order.order_file = f"data/orders-{storage}.csv"
+        order.order_log_dir = f"data/orders-{storage}"
+        order.checkpoint_file = f"data/orders-{storage}.ckpt"
+        order.order_storage = storage
+        order.init_txn_ctr()
+        for fsync in ["none", "batch"]:
+            order.order_fsync = fsync
+            for writers in writer_counts:
+                counts = [0] * writers
+
+                def writer(slot, start, stop):
+                    start.wait()
+                    while not stop.is_set():
+                        with order.scribble_lock:
+                            transaction_num = order.next_transaction
+                            order.next_transaction += 1
+                            ticket = order.queue_orders(
+                                [(transaction_num, "GameStart", "buy", 1)]
+                            )
+                        order.wait_logged(ticket)
+                        counts[slot] += 1
+
+                elapsed = run_timed(
+                    [functools.partial(writer, n) for n in range(writers)], DURATION
+                )
+                rate = sum(counts) / elapsed
+                print(
+                    f"{storage:>9} {fsync:>6} {writers:>8} {rate:>11.0f} {writers / rate * 1000:>8.3f}"
+                )
+
+
+benchmarks = {
+    "consistency": bench_consistency,
+    "log": bench_log,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(f"Usage: python order_benchmark.py [{'|'.join(benchmarks)}]")
+        sys.exit(1)
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        benchmarks[sys.argv[1]]()
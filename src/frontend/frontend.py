@@ -1,18 +1,33 @@
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qs
 import socket
+import struct
 import threading
 import os
 from collections import OrderedDict
 import sys
 import time
+import uuid
 
 CATALOG_HOST = os.environ.get("CATALOG_HOST", "localhost")
 CATALOG_PORT = int(os.environ.get("CATALOG_PORT", "6666"))
 ORDER_HOST = os.environ.get("ORDER_HOST", "localhost")
 ORDER_PORT = int(os.environ.get("ORDER_PORT", "7777"))
 PORT = int(os.environ.get("PORT", "5555"))
+# seconds to wait for the order leader before retrying; trades carry an
+# idempotency key, so a retry never trades twice
+ORDER_TIMEOUT = float(os.environ.get("ORDER_TIMEOUT", "5"))
+# order stats are served from a copy up to this many seconds old, so
+# dashboards polling the frontend don't each reach the order leader
+STATS_TTL = float(os.environ.get("STATS_TTL", "1"))
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "catalog")
+)
+from shard_map import load_shard_map
+
+SHARD_MAP = load_shard_map()  # None unless CATALOG_SHARDS names a shard map
 
 local_data = threading.local()
 
@@ -107,7 +122,10 @@ cache = LRUCache(7)
 
 # AI: ChatGPT4o
 # prompt: my cache doesnt get updated upon a trade. Give me some starter code for my catalog service to invalidate cache entries that have been updated. i want it in basic python and sockets, not flask.
-INVALIDATION_PORT = 5556
+INVALIDATION_PORT = int(os.environ.get("INVALIDATION_PORT", "5556"))
+# address the catalog should push invalidations to, and how often we renew
+INVALIDATION_HOST = os.environ.get("INVALIDATION_HOST", "localhost")
+SUBSCRIBE_INTERVAL = float(os.environ.get("SUBSCRIBE_INTERVAL", "10"))
 
 
 def invalidation_listener():
@@ -119,16 +137,75 @@ def invalidation_listener():
 
     while True:
         client_socket, addr = server.accept()
-        data = client_socket.recv(1024)
-        try:
-            message = json.loads(data.decode("utf-8"))
-            stock = message.get("invalidate")
-            if stock and stock in cache.cache:
-                del cache.cache[stock]
-                print(f"Cache invalidated via server push: {stock}")
-        except Exception as e:
-            print(f"Error in invalidation listener: {e}")
-        client_socket.close()
+        threading.Thread(
+            target=handle_invalidations, args=(client_socket,), daemon=True
+        ).start()
+
+
+def subscription_keeper():
+    # registering with each catalog shard doubles as our liveness heartbeat
+    synced_versions = {}  # shard id -> catalog version our cache reflects
+    last_versions = {}
+    while True:
+        subscribe_request = {
+            "action": "subscribe",
+            "host": INVALIDATION_HOST,
+            "port": INVALIDATION_PORT,
+        }
+        for shard in catalog_shards():
+            key = shard["id"] if shard else None
+            response = ask_catalog_shard(shard, subscribe_request)
+            if response.get("status") != "success":
+                continue
+            if response.get("new"):
+                # the catalog didn't know us, so we may have missed invalidations
+                synced_versions[key] = resync_cache(shard, synced_versions.get(key))
+                print(f"Subscribed to catalog invalidations at {INVALIDATION_HOST}:{INVALIDATION_PORT}")
+            elif key in last_versions:
+                # invalidations for changes made before the previous renewal
+                # have had a whole interval to arrive
+                synced_versions[key] = last_versions[key]
+            last_versions[key] = response.get("version")
+        time.sleep(SUBSCRIBE_INTERVAL)
+
+
+def resync_cache(shard, since):
+    # refresh only what changed since the given version instead of starting cold
+    response = None
+    if since is not None:
+        response = ask_catalog_shard(shard, {"action": "changes_since", "version": since})
+    if response is None or response.get("status") != "success" or response["version"] < since:
+        # can't tell what changed (or the catalog went back), drop its stocks
+        for name in list(cache.cache):
+            if shard is None or SHARD_MAP.shard_for(name) is shard:
+                cache.cache.pop(name, None)
+        return None
+    for stock_details in response["data"]:
+        if stock_details["name"] in cache.cache:
+            cache.cache[stock_details["name"]] = stock_details
+    print(f"Resynced cache: {len(response['data'])} stocks changed since version {since}")
+    return response["version"]
+
+
+def handle_invalidations(client_socket):
+    # the catalog keeps this connection open and sends one JSON frame per
+    # line, each naming one stock or a batch of them
+    try:
+        with client_socket, client_socket.makefile("r") as reader:
+            for line in reader:
+                try:
+                    message = json.loads(line)
+                    stocks = message.get("invalidate") or []
+                    if isinstance(stocks, str):
+                        stocks = [stocks]
+                    for stock in stocks:
+                        if cache.cache.pop(stock, None) is not None:
+                            print(f"Cache invalidated via server push: {stock}")
+                except Exception as e:
+                    print(f"Error in invalidation listener: {e}")
+                client_socket.sendall(b"ok\n")
+    except Exception as e:
+        print(f"Invalidation connection closed: {e}")
 
 
 # end prompt: my cache doesnt get updated upon a trade. Give me some starter code for my catalog service to invalidate cache entries that have been updated. i want it in basic python and sockets, not flask.
@@ -145,12 +222,25 @@ Handle sending JSON requests and receiving JSON responses
 """
 
 
-def get_catalog_socket():
-    if not hasattr(local_data, "catalog_socket"):
+def catalog_shards():
+    return SHARD_MAP.shards if SHARD_MAP is not None else [None]
+
+
+def catalog_address(shard):
+    if shard is None:
+        return (CATALOG_HOST, CATALOG_PORT)
+    return (shard["host"], shard["port"])
+
+
+def get_catalog_socket(shard=None):
+    if not hasattr(local_data, "catalog_sockets"):
+        local_data.catalog_sockets = {}
+    address = catalog_address(shard)
+    if address not in local_data.catalog_sockets:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((CATALOG_HOST, CATALOG_PORT))
-        local_data.catalog_socket = sock
-    return local_data.catalog_socket
+        sock.connect(address)
+        local_data.catalog_sockets[address] = sock
+    return local_data.catalog_sockets[address]
 
 
 def get_order_socket():
@@ -161,21 +251,62 @@ def get_order_socket():
     return local_data.order_socket
 
 
+def recv_json(sock):  # batched responses can be bigger than a single recv
+    data = b""
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError("connection closed before a full response")
+        data += chunk
+        try:
+            return json.loads(data.decode("utf-8"))
+        except ValueError:
+            continue  # response not complete yet
+
+
 def ask_catalog(request):
+    # send the request to the shard that owns its stock(s)
+    if SHARD_MAP is None:
+        return ask_catalog_shard(None, request)
+    if "stock_name" in request:
+        return ask_catalog_shard(SHARD_MAP.shard_for(request["stock_name"]), request)
+    if request["action"] == "lookup_many":
+        return lookup_many_sharded(request["stock_names"])
+    raise ValueError(f"Can't route catalog action {request['action']} to a shard")
+
+
+def lookup_many_sharded(stock_names):
+    # one lookup_many per shard; each shard's part is a consistent snapshot
+    found = {}
+    errors = {}
+    for shard_id, names in SHARD_MAP.group(stock_names).items():
+        shard_request = {"action": "lookup_many", "stock_names": names}
+        response = ask_catalog_shard(SHARD_MAP.by_id[shard_id], shard_request)
+        if response["status"] != "success":
+            return response
+        for stock_details in response["data"]:
+            found[stock_details["name"]] = stock_details
+        errors.update(response["errors"])
+    return {
+        "status": "success",
+        "data": [found[name] for name in stock_names if name in found],
+        "errors": errors,
+    }
+
+
+def ask_catalog_shard(shard, request):
     try:
-        sock = get_catalog_socket()
+        sock = get_catalog_socket(shard)
         sock.sendall(json.dumps(request).encode("utf-8"))
-        response = sock.recv(4096)  # Receive response from the socket
-        return json.loads(response.decode("utf-8"))
+        return recv_json(sock)  # Receive response from the socket
     except Exception as e:
         print(f"Error talking to catalog: {e}")
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((CATALOG_HOST, CATALOG_PORT))
-            local_data.catalog_socket = sock
+            sock.connect(catalog_address(shard))
+            local_data.catalog_sockets[catalog_address(shard)] = sock
             sock.sendall(json.dumps(request).encode("utf-8"))
-            response = sock.recv(4096)
-            return json.loads(response.decode("utf-8"))
+            return recv_json(sock)
         except Exception as e2:
             print(f"Reconnection failed: {e2}")
             return {
@@ -200,13 +331,12 @@ def ask_order(request):
 
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(5)  # We are setting a timeout value here
+                sock.settimeout(ORDER_TIMEOUT)  # We are setting a timeout value here
                 sock.connect((leader["host"], leader["port"]))
                 sock.sendall(
                     json.dumps(request).encode("utf-8")
                 )  # Use standard sendall
-                response = sock.recv(4096)
-                return json.loads(response.decode("utf-8"))
+                return recv_json(sock)
 
         except Exception as e:
             print(f"Error talking to leader: {e}")
@@ -222,9 +352,126 @@ def ask_order(request):
     }
 
 
+FRAME_HEADER = struct.Struct(">I")  # order service frames: length, then JSON
+MAX_FRAME = 64 << 20  # same limit as the order service
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock):
+    # None if the connection closed before a whole frame arrived
+    header = recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    (size,) = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME:
+        raise ValueError(f"frame of {size} bytes is too large")
+    payload = recv_exactly(sock, size)
+    if payload is None:
+        return None
+    return json.loads(payload.decode("utf-8"))
+
+
+def open_order_stream(request):
+    # (socket, first frame) of a streamed reply from the leader, or
+    # (None, error response); the caller reads the rest and closes the socket
+    global leader
+    for _ in range(3):
+        if leader is None:
+            leader_selection()
+            if leader is None:
+                break
+        sock = None
+        try:
+            sock = socket.create_connection(
+                (leader["host"], leader["port"]), timeout=ORDER_TIMEOUT
+            )
+            sock.sendall(json.dumps(request).encode("utf-8"))
+            frame = recv_frame(sock)
+            if frame is None:
+                raise ConnectionError("order service closed the connection")
+            return sock, frame
+        except Exception as e:
+            print(f"Error talking to leader: {e}")
+            if sock is not None:
+                sock.close()
+            leader = None
+    return None, {
+        "status": "error",
+        "error": {"code": 503, "message": "Order service unavailable"},
+    }
+
+
+stats_cache = {}  # (stock, minutes) -> (time fetched, order service reply)
+stats_lock = threading.Lock()
+
+
+def order_stats(stock_name, minutes):
+    key = (stock_name, minutes)
+    with stats_lock:
+        cached = stats_cache.get(key)
+    if cached is not None and time.time() - cached[0] < STATS_TTL:
+        return cached[1]
+    order_request = {"action": "stats"}
+    if stock_name is not None:
+        order_request["stock_name"] = stock_name
+    if minutes is not None:
+        order_request["minutes"] = minutes
+    service_response = ask_order(order_request)
+    if service_response["status"] == "success":
+        with stats_lock:
+            if len(stats_cache) > 1000:
+                stats_cache.clear()
+            stats_cache[key] = (time.time(), service_response)
+    return service_response
+
+
+def idempotency_key(headers, data):
+    # the client's key (Idempotency-Key header or "idempotency_key" field) so
+    # its own retries are safe too, else a fresh one for our retries
+    return headers.get("Idempotency-Key") or data.get("idempotency_key") or uuid.uuid4().hex
+
+
+def lookup_stocks(stock_names):
+    # serve what we can from the cache and fetch the rest in one catalog call
+    found = {}
+    missing = []
+    for name in stock_names:
+        stock_details = cache.get(name) if CACHE_FLAG else -1
+        if stock_details == -1:
+            missing.append(name)
+        else:
+            found[name] = stock_details
+    errors = {}
+    if missing:
+        catalog_request = {"action": "lookup_many", "stock_names": missing}
+        service_response = ask_catalog(catalog_request)
+        if service_response["status"] != "success":
+            return service_response
+        for stock_details in service_response["data"]:
+            found[stock_details["name"]] = stock_details
+            if CACHE_FLAG:
+                cache.put(stock_details["name"], stock_details)
+        errors = service_response["errors"]
+    return {
+        "status": "success",
+        "data": [found[name] for name in stock_names if name in found],
+        "errors": errors,
+    }
+
+
 class StockHandler(BaseHTTPRequestHandler):
     def do_GET(self):
-        parsed_path = urlparse(self.path).path
+        parsed_url = urlparse(self.path)
+        parsed_path = parsed_url.path
 
         if parsed_path.startswith("/stocks/"):
             stock_name = parsed_path[8:]
@@ -261,6 +508,30 @@ class StockHandler(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(json.dumps(response).encode("utf-8"))
 
+        elif parsed_path == "/orders/stats":
+            # GET /orders/stats?stock=BoarCo&minutes=15
+            params = parse_qs(parsed_url.query)
+            stock_name = params.get("stock", [None])[0]
+            minutes = params.get("minutes", [None])[0]
+            if minutes is None or minutes.isdigit():
+                service_response = order_stats(
+                    stock_name, None if minutes is None else int(minutes)
+                )
+            else:
+                service_response = {
+                    "status": "error",
+                    "error": {"code": 400, "message": "Invalid minutes"},
+                }
+            if service_response["status"] == "success":
+                response = {"data": service_response["data"]}
+                self.send_response(200)
+            else:
+                response = {"error": service_response["error"]}
+                self.send_response(service_response["error"]["code"])
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(response).encode("utf-8"))
+
         elif parsed_path.startswith("/orders/"):
             order_num = parsed_path[8:]
             if order_num.isdigit():
@@ -281,6 +552,62 @@ class StockHandler(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(json.dumps(response).encode("utf-8"))
 
+        elif parsed_path == "/orders":
+            # GET /orders?stock=BoarCo&from=<unix time>&to=<unix time>&limit=100
+            params = parse_qs(parsed_url.query)
+            order_request = {"action": "query_orders"}
+            try:
+                if "stock" in params:
+                    order_request["stock_name"] = params["stock"][0]
+                for param in ("from", "to"):
+                    if param in params:
+                        order_request[param] = float(params[param][0])
+                if "limit" in params:
+                    order_request["limit"] = int(params["limit"][0])
+            except ValueError:
+                order_request = None
+            if order_request is None:
+                sock = None
+                service_response = {
+                    "status": "error",
+                    "error": {"code": 400, "message": "Invalid order query"},
+                }
+            else:
+                print(f"Querying orders: {order_request}")
+                sock, service_response = open_order_stream(order_request)
+            if service_response.get("status") == "error":
+                if sock is not None:
+                    sock.close()
+                response = {"error": service_response["error"]}
+                self.send_response(service_response["error"]["code"])
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps(response).encode("utf-8"))
+            else:
+                self.stream_orders(sock, service_response)
+
+        elif parsed_path == "/stocks":
+            names = parse_qs(parsed_url.query).get("names", [""])[0].split(",")
+            stock_names = list(dict.fromkeys(name for name in names if name))
+            if stock_names:
+                print(f"Looking up stocks: {stock_names}")
+                service_response = lookup_stocks(stock_names)
+                if service_response["status"] == "success":
+                    response = {
+                        "data": service_response["data"],
+                        "errors": service_response["errors"],
+                    }
+                    self.send_response(200)
+                else:
+                    response = {"error": service_response["error"]}
+                    self.send_response(service_response["error"]["code"])
+            else:
+                response = {"error": {"code": 400, "message": "No stock names given"}}
+                self.send_response(400)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(response).encode("utf-8"))
+
         else:
             self.send_error(404, "Invalid endpoint")
 
@@ -288,6 +615,35 @@ class StockHandler(BaseHTTPRequestHandler):
      End AI-assisted code piece
      """
 
+    def stream_orders(self, sock, frame):
+        # write {"data": [...]} as the order service's frames arrive, so a big
+        # result never sits in memory; the body ends when the connection does
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b'{"data": [')
+        separator = b""
+        try:
+            while True:
+                for order in frame["orders"]:
+                    self.wfile.write(separator + json.dumps(order).encode("utf-8"))
+                    separator = b", "
+                if frame.get("done"):
+                    self.wfile.write(b"]}")
+                    return
+                frame = recv_frame(sock)
+                if frame is None:
+                    raise ConnectionError("order service closed the connection")
+        except (OSError, ValueError) as e:
+            print(f"Order query stream broke: {e}")
+            error = {"code": 503, "message": "Order query interrupted"}
+            try:
+                self.wfile.write(b'], "error": ' + json.dumps(error).encode("utf-8") + b"}")
+            except OSError:
+                pass  # the client is gone too
+        finally:
+            sock.close()
+
     def do_POST(self):
         parsed_path = urlparse(self.path).path
         if parsed_path == "/orders":
@@ -304,7 +660,11 @@ class StockHandler(BaseHTTPRequestHandler):
                     "stock_name": stock_name,
                     "quantity": quantity,
                     "order_type": order_type,
+                    "idempotency_key": idempotency_key(self.headers, data),
                 }
+                if "consistency" in data:
+                    # async, quorum or all; the order service defaults it
+                    order_request["consistency"] = data["consistency"]
                 service_response = ask_order(order_request)
                 if service_response["status"] == "success":
                     response = {"data": service_response["data"]}
@@ -321,6 +681,44 @@ class StockHandler(BaseHTTPRequestHandler):
                 self.send_header("Content-Type", "application/json")
                 self.end_headers()
                 self.wfile.write(json.dumps(response).encode("utf-8"))
+        elif parsed_path == "/orders/batch":
+            content_length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(content_length)
+            try:
+                data = json.loads(body.decode("utf-8"))
+                orders = [
+                    {
+                        "stock_name": order.get("name"),
+                        "quantity": order.get("quantity"),
+                        "order_type": order.get("type"),
+                    }
+                    for order in data.get("orders", [])
+                ]
+                print(f"Processing batch of {len(orders)} orders")
+                order_request = {
+                    "action": "trade_batch",
+                    "orders": orders,
+                    "idempotency_key": idempotency_key(self.headers, data),
+                }
+                if "consistency" in data:
+                    order_request["consistency"] = data["consistency"]
+                service_response = ask_order(order_request)
+                # per-order results, each a transaction number or an error
+                if service_response["status"] == "success":
+                    response = {"data": service_response["data"]}
+                    self.send_response(200)
+                else:
+                    response = {"error": service_response["error"]}
+                    self.send_response(service_response["error"]["code"])
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps(response).encode("utf-8"))
+            except (json.JSONDecodeError, AttributeError):
+                response = {"error": {"code": 400, "message": "Invalid JSON format"}}
+                self.send_response(400)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps(response).encode("utf-8"))
         else:
             self.send_error(404, "Invalid endpoint")
 
@@ -330,6 +728,7 @@ def serve():
     host = "0.0.0.0"
     port = PORT
     threading.Thread(target=invalidation_listener, daemon=True).start()
+    threading.Thread(target=subscription_keeper, daemon=True).start()
     server = ThreadingHTTPServer((host, port), StockHandler)
     print(f"Frontend server running on port {port}")
     server.serve_forever()
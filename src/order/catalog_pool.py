@@ -0,0 +1,114 @@
+import json
+import os
+import select
+import socket
+import threading
+
+# Persistent connections from the order service to the catalog, shared by all
+# handle_client threads of order.py and paxos_order.py. The catalog serves any
+# number of requests per connection, so a trade reuses an idle connection
+# instead of paying for a connect and close. Each catalog address (one per
+# shard when the catalog is sharded) gets its own pool of at most
+# CATALOG_POOL_SIZE connections; callers beyond that wait for one to free up.
+
+pool_size = int(os.environ.get("CATALOG_POOL_SIZE", "8"))
+pool_timeout = 5  # seconds, for connecting and for each reply
+
+
+class NotProcessed(ConnectionError):
+    # the request never reached the catalog (sending it failed) or the catalog
+    # closed the connection without a byte of reply, so it is safe to resend
+    pass
+
+
+def recv_json(sock):
+    # replies can be bigger than a single recv
+    data = b""
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            if not data:
+                raise NotProcessed("catalog closed the connection")
+            raise ConnectionError("catalog closed the connection mid-reply")
+        data += chunk
+        try:
+            return json.loads(data.decode("utf-8"))
+        except ValueError:
+            continue  # message not complete yet
+
+
+class CatalogPool:
+    def __init__(self, host, port, size=pool_size):
+        self.host = host
+        self.port = port
+        self.idle = []  # connections nobody is using, most recent last
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        return socket.create_connection((self.host, self.port), timeout=pool_timeout)
+
+    def healthy(self, sock):
+        # an idle connection should have nothing to read; if it is readable,
+        # the catalog closed it (or it is out of step) and it can't be reused
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            return not readable
+        except (OSError, ValueError):
+            return False
+
+    def checkout(self):
+        # (connection, whether it was reused)
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                sock = self.idle.pop()
+            if self.healthy(sock):
+                return sock, True
+            sock.close()
+        return self.connect(), False
+
+    def exchange(self, sock, payload):
+        try:
+            sock.sendall(payload)
+        except socket.timeout:
+            raise  # part of the request may have gone out
+        except OSError as e:
+            raise NotProcessed(f"sending to the catalog failed: {e}") from e
+        return recv_json(sock)
+
+    def request(self, message):
+        payload = json.dumps(message).encode("utf-8")
+        with self.slots:
+            sock, reused = self.checkout()
+            try:
+                response = self.exchange(sock, payload)
+            except OSError as e:
+                sock.close()
+                # the catalog dropped a pooled connection between the health
+                # check and our request (e.g. it restarted): one fresh attempt.
+                # After a timeout or a cut-off reply the catalog may already
+                # have applied an update, so those are never resent.
+                if not reused or not isinstance(e, NotProcessed):
+                    raise
+                sock = self.connect()
+                try:
+                    response = self.exchange(sock, payload)
+                except OSError:
+                    sock.close()
+                    raise
+            with self.lock:
+                self.idle.append(sock)
+            return response
+
+
+pools = {}  # (host, port) -> CatalogPool
+pools_lock = threading.Lock()
+
+
+def catalog_pool(host, port):
+    with pools_lock:
+        if (host, port) not in pools:
+            pools[(host, port)] = CatalogPool(host, port)
+        return pools[(host, port)]
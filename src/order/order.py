@@ -1,31 +1,118 @@
+import collections
 import socket
+import struct
 import threading
 import json
 import csv
+import io
 import os
 import time
 import sys
+import shutil
+import zlib
+from catalog_pool import catalog_pool
+from segment_log import SegmentLog
+from secondary_index import SecondaryIndex
+from trade_stats import TradeStats
 
 # Basic variables initialization
 next_transaction = 0
 scribble_lock = threading.Lock()
+order_index = {}  # transaction number -> byte offset of its row in order_file
+index_ready = threading.Event()  # set once order_index covers the whole log
+# bumped whenever an installed snapshot replaces order_file, so a background
+# history scan of the old file knows to throw its offsets away
+log_generation = 0
+last_logged = -1  # highest transaction number in order_file
+# orders by stock name and by time, for query_orders; kept up to date by
+# write_orders, with the history from before startup indexed in the background
+order_queries = SecondaryIndex()
+# per-stock totals and per-minute buckets for the last ORDER_STATS_MINUTES
+# minutes, for the stats action; maintained the same way
+stats_minutes = int(os.environ.get("ORDER_STATS_MINUTES", "60"))
+order_stats = TradeStats(stats_minutes)
+
+# every ORDER_CHECKPOINT_EVERY orders, record how far the csv log goes so a
+# restart only has to read what was written after that
+checkpoint_every = int(os.environ.get("ORDER_CHECKPOINT_EVERY", "1000"))
+unchecked_orders = 0  # orders logged since the last checkpoint
+
+# Orders are appended by one log writer thread. Orders that arrive while it is
+# busy are written together with one write, and with ORDER_FSYNC=batch one
+# fsync; whoever queued them is released once their batch is done.
+order_fsync = os.environ.get("ORDER_FSYNC", "none")  # none | batch
+log_queue = []  # orders waiting for the log writer
+# (first, end, replicate) for the queued orders the leader sends to its
+# followers once they are logged, see queue_orders
+log_replicated = []
+log_cond = threading.Condition()
+queued_orders = 0  # orders ever handed to the log writer
+written_orders = 0  # orders the log writer has finished with
+failed_orders = set()  # positions in the queue that could not be written
+log_writer_running = False
+# held by the log writer for each write, so whoever holds it sees the log
+# files as they are on disk, with no write half done
+write_lock = threading.Lock()
+order_handle = None  # append handle on order_file, kept open by the log writer
+
+# csv keeps the order log in data/ordersN.csv; segments keeps it as binary
+# segments under data/ordersN/ (see segment_log.py)
+order_storage = os.environ.get("ORDER_STORAGE", "csv")
+segment_bytes = int(os.environ.get("ORDER_SEGMENT_BYTES", str(4 << 20)))
+order_log = None  # SegmentLog when order_storage is "segments"
+
+# replica catch-up streams newer orders in pages of this many orders
+catchup_page = int(os.environ.get("ORDER_CATCHUP_PAGE", "1000"))
+catchup_attempts = 3  # per replica, each resuming where the last one stopped
+# a replica this many orders behind a peer copies the peer's log files first
+snapshot_threshold = int(os.environ.get("ORDER_SNAPSHOT_THRESHOLD", "10000"))
+FRAME_HEADER = struct.Struct(">I")
+# the leader streams new orders to each follower; a stream keeps at most
+# replication_window unacknowledged frames out and queues at most
+# replication_queue_limit orders in memory (older ones are re-read from the log)
+replication_window = int(os.environ.get("ORDER_REPLICATION_WINDOW", "32"))
+replication_queue_limit = int(os.environ.get("ORDER_REPLICATION_QUEUE", "10000"))
+# how many replicas must have logged a trade before it is acknowledged: async
+# (just the leader), quorum (a majority of the replicas) or all; a trade
+# request can ask for its own level with a "consistency" field
+consistency_levels = ["async", "quorum", "all"]
+default_consistency = os.environ.get("ORDER_CONSISTENCY", "async")
+ack_timeout = int(os.environ.get("ORDER_ACK_TIMEOUT_MS", "2000")) / 1000
+acks_changed = threading.Condition()  # notified whenever a follower acks
+MAX_FRAME = 64 << 20
+# trades may carry an "idempotency_key"; a repeat of a key seen in the last
+# ORDER_IDEMPOTENCY_TTL seconds gets the first trade's response instead of
+# trading again. At most ORDER_IDEMPOTENCY_KEYS keys are remembered.
+idempotency_ttl = float(os.environ.get("ORDER_IDEMPOTENCY_TTL", "600"))
+idempotency_limit = int(os.environ.get("ORDER_IDEMPOTENCY_KEYS", "100000"))
 
 
 # Use environment variable to set catalog host/port
 catalog_host = os.environ.get("CATALOG_HOST", "localhost")
 catalog_port = int(os.environ.get("CATALOG_PORT", "6666"))
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "catalog")
+)
+from shard_map import load_shard_map
+
+shard_map = load_shard_map()  # None unless CATALOG_SHARDS names a shard map
 replica_no = 0
 order_file = "data/orders0.csv"
+order_log_dir = "data/orders0"
+checkpoint_file = "data/orders0.ckpt"
 server_port = 7777
 
 
 def setup_replicas():
-    global replica_no, order_file, server_port
+    global replica_no, order_file, order_log_dir, checkpoint_file, server_port
     if len(sys.argv) > 1:
         replica_no = int(sys.argv[1])
     else:
         replica_no = 0
     order_file = f"data/orders{replica_no}.csv"
+    order_log_dir = f"data/orders{replica_no}"
+    checkpoint_file = f"data/orders{replica_no}.ckpt"
     server_port = 7777 + replica_no
 
 
@@ -40,36 +127,242 @@ Now help me implement a Python HTTP server for processing stock orders.
 
 
 def save_order(transaction_num, stock_name, order_type, quantity):
-    try:
+    log_orders([(transaction_num, stock_name, order_type, quantity)])
+
+
+def log_orders(orders):
+    # orders: (transaction number, stock name, order type, quantity) tuples,
+    # optionally followed by the trade's timestamp (replicated orders keep theirs)
+    failed = wait_logged(queue_orders(orders))
+    if failed:
+        raise IOError(f"failed to log {len(failed)} of {len(orders)} orders")
+
+
+def queue_orders(orders, replicate=None):
+    # hand orders to the log writer; returns a ticket for wait_logged. Once
+    # the orders are written, replicate(failed positions) gives the orders to
+    # send to the followers; it runs on the log writer, before the ticket is
+    # released, and in the order the orders were queued.
+    global queued_orders, log_writer_running
+    timestamp = time.time()
+    orders = [order if len(order) > 4 else (*order, timestamp) for order in orders]
+    with log_cond:
+        if not log_writer_running:
+            threading.Thread(target=log_writer, daemon=True).start()
+            log_writer_running = True
+        log_queue.extend(orders)
+        queued_orders += len(orders)
+        ticket = queued_orders - len(orders), queued_orders
+        if replicate is not None:
+            log_replicated.append((*ticket, replicate))
+        log_cond.notify_all()
+        return ticket
+
+
+def wait_logged(ticket):
+    # positions within the queued orders that could not be logged; the
+    # others are in the log (and on disk with ORDER_FSYNC=batch)
+    start, end = ticket
+    with log_cond:
+        while written_orders < end:
+            log_cond.wait()
+        if not failed_orders:
+            return []
+        failed = [n - start for n in range(start, end) if n in failed_orders]
+        failed_orders.difference_update(range(start, end))
+        return failed
+
+
+def log_writer():
+    global log_queue, log_replicated, written_orders
+    while True:
+        with log_cond:
+            while not log_queue:
+                log_cond.wait()
+            batch = log_queue
+            log_queue = []
+            replicated = log_replicated
+            log_replicated = []
+            ticket = queued_orders
+        failed = []
+        with write_lock:
+            try:
+                write_orders(batch)
+            except Exception as e:
+                print(f"Failed to log a batch of {len(batch)} orders: {e}")
+                # one order at a time, so only the orders that really can't be
+                # logged fail; whoever queued those gets an error, not an ack
+                first = ticket - len(batch)
+                for n, order in enumerate(batch):
+                    try:
+                        write_orders([order])
+                    except Exception as e:
+                        print(f"Failed to log order {order[0]}: {e}")
+                        failed.append(first + n)
+        # followers only ever get orders the leader has logged
+        for start, end, replicate in replicated:
+            try:
+                orders = replicate([n - start for n in failed if start <= n < end])
+                propagate_to_followers(orders)
+            except Exception as e:
+                print(f"Failed to replicate orders: {e}")
+        with log_cond:
+            failed_orders.update(failed)
+            written_orders = ticket
+            log_cond.notify_all()
+
+
+def write_orders(orders):
+    # raises only if the orders did not make it into the log, so the log
+    # writer can write them again
+    global last_logged, unchecked_orders, order_handle
+    if order_log is not None:
+        order_log.append(orders)
+        if order_fsync == "batch":
+            order_log.sync()
+        index_logged(orders)
+        return
+    if order_handle is None:
         if not os.path.exists("data"):
             os.makedirs("data")
-        file_exists = os.path.exists(order_file)
-        with open(order_file, "a", newline="") as file:
-            writer = csv.writer(file)
-            if not file_exists:
-                writer.writerow(
-                    [
-                        "transaction_number",
-                        "stock_name",
-                        "order_type",
-                        "quantity",
-                        "timestamp",
-                    ]
-                )
-            writer.writerow(
-                [transaction_num, stock_name, order_type, quantity, time.time()]
-            )
+        order_handle = open(order_file, "ab")
+    start = order_handle.seek(0, os.SEEK_END)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if start == 0:
+        writer.writerow(
+            [
+                "transaction_number",
+                "stock_name",
+                "order_type",
+                "quantity",
+                "timestamp",
+            ]
+        )
+    # format the whole batch first, so it goes out in one write
+    lines = [buffer.getvalue().encode("utf-8")]
+    offsets = []
+    offset = start + len(lines[0])
+    for order in orders:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(order)
+        line = buffer.getvalue().encode("utf-8")
+        offsets.append((order[0], offset))
+        lines.append(line)
+        offset += len(line)
+    try:
+        order_handle.write(b"".join(lines))
+        order_handle.flush()
+        if order_fsync == "batch":
+            os.fsync(order_handle.fileno())
+    except Exception:
+        # don't leave half a batch in front of the next write
+        order_handle.close()
+        order_handle = None
+        os.truncate(order_file, start)
+        raise
+    # only index the rows once they are fully written
+    order_index.update(offsets)
+    last_logged = max(last_logged, max(order[0] for order in orders))
+    unchecked_orders += len(orders)
+    index_logged(orders)
+    if unchecked_orders >= checkpoint_every:
+        try:
+            write_checkpoint(offset)
+        except Exception as e:
+            # the rows are in; the next batch tries the checkpoint again
+            print(f"Failed to checkpoint {order_file}: {e}")
+
+
+def index_logged(orders):
+    # the orders are in the log by now, so a failure here must not fail them
+    try:
+        for order in orders:
+            order_queries.add(order[0], order[1], order[4])
+            order_stats.add(*order[:5])
     except Exception as e:
-        print(f"Failed to log order: {e}")
+        print(f"Failed to index orders up to {orders[-1][0]} for queries: {e}")
+
+
+def lookup_order_record(transaction_num):
+    if order_log is not None:
+        return order_log.lookup(transaction_num)
+    offset = order_index.get(transaction_num)
+    if offset is None and not index_ready.is_set():
+        # still indexing the history from before the checkpoint
+        index_ready.wait()
+        offset = order_index.get(transaction_num)
+    if offset is None:
+        return None
+    with open(order_file, "r", newline="") as file:
+        file.seek(offset)
+        row = next(csv.reader(file))
+    return order_from_row(row)
+
+
+def iter_orders_after(last_transaction):
+    # logged orders with a higher transaction number, in log order
+    if order_log is not None:
+        yield from order_log.iter_from(last_transaction + 1)
+        return
+    if not os.path.exists(order_file):
+        return
+    with open(order_file, "r", newline="") as file:
+        # if we have the next transaction, everything after it is newer
+        offset = order_index.get(last_transaction + 1)
+        if offset is not None:
+            file.seek(offset)
+        reader = csv.reader(file)
+        for row in reader:
+            if len(row) >= 4 and row[0].isdigit() and int(row[0]) > last_transaction:
+                yield order_from_row(row)
+
+
+def read_orders(transaction_nums):
+    # the logged orders with these transaction numbers, in the given order
+    if order_log is not None:
+        for transaction_num in transaction_nums:
+            record = order_log.lookup(transaction_num)
+            if record is not None:
+                yield record
+        return
+    index_ready.wait()
+    with open(order_file, "r", newline="") as file:
+        for transaction_num in transaction_nums:
+            offset = order_index.get(transaction_num)
+            if offset is not None:
+                file.seek(offset)
+                yield order_from_row(next(csv.reader(file)))
+
+
+def order_from_row(row):
+    return {
+        "transaction_number": int(row[0]),
+        "stock_name": row[1],
+        "order_type": row[2],
+        "quantity": int(row[3]),
+        "timestamp": float(row[4]) if len(row) > 4 else None,
+    }
 
 
-def ask_catalog(request):
+def last_logged_transaction():
+    if order_log is not None:
+        return order_log.last_transaction
+    return last_logged
+
+
+def catalog_address(request):
+    # with a sharded catalog, the shard owning the stock answers
+    if shard_map is not None and "stock_name" in request:
+        shard = shard_map.shard_for(request["stock_name"])
+        return shard["host"], shard["port"]
+    return catalog_host, catalog_port
+
+
+def ask_catalog(request, address=None):
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.connect((catalog_host, catalog_port))
-            sock.sendall(json.dumps(request).encode("utf-8"))
-            response = sock.recv(4096)
-            return json.loads(response.decode("utf-8"))
+        return catalog_pool(*(address or catalog_address(request))).request(request)
     except Exception as e:
         return {
             "status": "error",
@@ -80,8 +373,111 @@ def ask_catalog(request):
         }
 
 
-def process_trade(stock_name, quantity, order_type):
+class DedupTable:
+    # Idempotency key -> response of the trade that first used it. Entries are
+    # kept oldest first, so expired ones and the overflow past the limit come
+    # off the front. A key is claimed before its trade runs, so a repeat that
+    # arrives meanwhile (a hedged or timed-out retry) waits for that trade
+    # instead of running its own.
+    def __init__(self, limit, ttl):
+        self.limit = limit
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> entry
+        self.lock = threading.Lock()
+
+    def expire(self, now):
+        while self.entries:
+            entry = next(iter(self.entries.values()))
+            if entry["expires"] > now and len(self.entries) <= self.limit:
+                break
+            self.entries.popitem(last=False)
+
+    def claim(self, key):
+        # (entry, whether the caller is the first with this key and must run)
+        now = time.time()
+        with self.lock:
+            self.expire(now)
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry, False
+            entry = {"expires": now + self.ttl, "response": None, "done": threading.Event()}
+            self.entries[key] = entry
+            self.expire(now)
+            return entry, True
+
+    def finish(self, key, entry, response, keep=True):
+        entry["response"] = response
+        entry["done"].set()
+        if not keep:
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+
+    def remember(self, key, response):
+        # a key the leader replicated along with its order
+        entry, first = self.claim(key)
+        if first:
+            self.finish(key, entry, response)
+
+    def wait(self, entry):
+        entry["done"].wait()
+        return entry["response"]
+
+
+dedup_table = DedupTable(idempotency_limit, idempotency_ttl)
+
+
+def deduplicated(key, run):
+    # run() unless key was used before; then answer what its first run answered
+    if key is None:
+        return run()
+    if not isinstance(key, str):
+        return {
+            "status": "error",
+            "error": {"code": 400, "message": "idempotency_key must be a string"},
+        }
+    entry, first = dedup_table.claim(key)
+    if not first:
+        return dedup_table.wait(entry)
+    response = None
+    try:
+        response = run()
+    finally:
+        # a catalog that could not be reached traded nothing, so a retry
+        # with the same key should get to try again
+        failed = response is None or (
+            response["status"] == "error" and response["error"]["code"] == 500
+        )
+        if response is None:
+            response = {
+                "status": "error",
+                "error": {"code": 500, "message": "trade failed"},
+            }
+        dedup_table.finish(key, entry, response, keep=not failed)
+    return response
+
+
+def with_key(order, key, response):
+    # the order as replicated: followers remember key -> response with it
+    if key is None:
+        return order
+    return order + ([key, response],)
+
+
+def process_trade(stock_name, quantity, order_type, consistency=None, idempotency_key=None):
+    return deduplicated(
+        idempotency_key,
+        lambda: place_trade(stock_name, quantity, order_type, consistency, idempotency_key),
+    )
+
+
+def place_trade(stock_name, quantity, order_type, consistency, idempotency_key):
     global next_transaction
+    if not valid_order({"stock_name": stock_name, "quantity": quantity, "order_type": order_type}):
+        return {"status": "error", "error": {"code": 400, "message": "invalid order"}}
+    consistency = consistency or default_consistency
+    if consistency not in consistency_levels:
+        return unknown_consistency(consistency)
     quantity_change = quantity if order_type == "sell" else -quantity
     catalog_request = {
         "action": "update",
@@ -94,12 +490,177 @@ def process_trade(stock_name, quantity, order_type):
     with scribble_lock:
         transaction_num = next_transaction
         next_transaction += 1
-        save_order(transaction_num, stock_name, order_type, quantity)
+        order = (transaction_num, stock_name, order_type, quantity, time.time())
+        response = {"status": "success", "data": {"transaction_number": transaction_num}}
+        # queued in transaction order; the followers get the order (and the
+        # key's response) only if we manage to log it
+        ticket = queue_orders(
+            [order],
+            lambda failed: [] if failed else [with_key(order, idempotency_key, response)],
+        )
+    # wait for our batch outside the lock, so the next trades can join it
+    if wait_logged(ticket):
+        # give the catalog back what the trade took
+        ask_catalog(dict(catalog_request, quantity_change=-quantity_change))
+        return log_failure()
+
+    error = replication_shortfall(transaction_num, consistency)
+    if error:
+        return error
+
+    return response
+
+
+def log_failure():
+    return {"status": "error", "error": {"code": 500, "message": "failed to log the order"}}
+
+
+def unknown_consistency(consistency):
+    return {
+        "status": "error",
+        "error": {"code": 400, "message": f"unknown consistency level {consistency}"},
+    }
+
+
+def replication_shortfall(transaction_num, consistency):
+    # error response if too few followers logged up to transaction_num in time
+    needed = followers_needed(consistency)
+    acked = wait_for_acks(transaction_num, needed)
+    if acked >= needed:
+        return None
+    return {
+        "status": "error",
+        "error": {
+            "code": 503,
+            "message": f"only {acked} of {needed} followers logged the trade in time",
+            "transaction_number": transaction_num,
+        },
+    }
+
+
+def valid_order(order):
+    return (
+        isinstance(order.get("stock_name"), str)
+        and order.get("order_type") in ("buy", "sell")
+        and isinstance(order.get("quantity"), int)
+        and order["quantity"] > 0
+    )
+
+
+def order_leg(order):
+    quantity = order["quantity"]
+    change = quantity if order["order_type"] == "sell" else -quantity
+    return {"stock_name": order["stock_name"], "quantity_change": change}
+
+
+def apply_to_catalog(orders):
+    # Apply a batch of orders with one update_many per catalog (shard).
+    # update_many is all-or-nothing and names the stock that failed, so that
+    # stock's orders are set aside and the rest retried; the orders set aside
+    # then go one update at a time. Returns {position: error} for the orders
+    # that could not be applied.
+    groups = {}
+    for position, order in enumerate(orders):
+        groups.setdefault(catalog_address(order_leg(order)), []).append(position)
+    errors = {}
+    for address, pending in groups.items():
+        aside = []
+        while pending:
+            request = {
+                "action": "update_many",
+                "legs": [order_leg(orders[p]) for p in pending],
+            }
+            response = ask_catalog(request, address)
+            if response["status"] == "success":
+                break
+            failed = response["error"].get("stock_name")
+            if failed is None:
+                for p in pending:
+                    errors[p] = response["error"]
+                break
+            aside += [p for p in pending if orders[p]["stock_name"] == failed]
+            pending = [p for p in pending if orders[p]["stock_name"] != failed]
+        for p in aside:
+            request = dict(order_leg(orders[p]), action="update")
+            response = ask_catalog(request, address)
+            if response["status"] == "error":
+                errors[p] = response["error"]
+    return errors
 
-    # Propagate to followers
-    propagate_to_followers(transaction_num, stock_name, order_type, quantity)
 
-    return {"status": "success", "data": {"transaction_number": transaction_num}}
+def process_trade_batch(orders, consistency=None, idempotency_key=None):
+    return deduplicated(
+        idempotency_key,
+        lambda: place_trade_batch(orders, consistency, idempotency_key),
+    )
+
+
+def place_trade_batch(orders, consistency, idempotency_key):
+    # many trades in one go: one catalog call per shard, one contiguous range
+    # of transaction numbers, one log append and one replication frame
+    global next_transaction
+    consistency = consistency or default_consistency
+    if consistency not in consistency_levels:
+        return unknown_consistency(consistency)
+    results = [None] * len(orders)
+    valid = []
+    for i, order in enumerate(orders):
+        if valid_order(order):
+            valid.append(i)
+        else:
+            results[i] = {"error": {"code": 400, "message": "invalid order"}}
+    errors = apply_to_catalog([orders[i] for i in valid])
+    filled = []
+    for position, i in enumerate(valid):
+        if position in errors:
+            results[i] = {"error": errors[position]}
+        else:
+            filled.append(i)
+    if not filled:
+        return {"status": "success", "data": {"results": results}}
+
+    with scribble_lock:
+        first = next_transaction
+        next_transaction += len(filled)
+        timestamp = time.time()
+        logged = [
+            (
+                first + n,
+                orders[i]["stock_name"],
+                orders[i]["order_type"],
+                orders[i]["quantity"],
+                timestamp,
+            )
+            for n, i in enumerate(filled)
+        ]
+        for n, i in enumerate(filled):
+            results[i] = {"transaction_number": first + n}
+        response = {"status": "success", "data": {"results": results}}
+
+        def replicate(failed):
+            # settle the response before the followers remember it; the key
+            # rides on the last order that was logged
+            for n in failed:
+                results[filled[n]] = {"error": log_failure()["error"]}
+            written = [order for n, order in enumerate(logged) if n not in failed]
+            if not written:
+                return []
+            return written[:-1] + [with_key(written[-1], idempotency_key, response)]
+
+        ticket = queue_orders(logged, replicate)
+    failed = [filled[n] for n in wait_logged(ticket)]
+    if failed:
+        # give the catalog back what the unlogged orders took
+        undo = {"buy": "sell", "sell": "buy"}
+        apply_to_catalog([dict(orders[i], order_type=undo[orders[i]["order_type"]]) for i in failed])
+
+    error = replication_shortfall(first + len(filled) - 1, consistency)
+    if error:
+        # the orders are filled and logged all the same; say which they are
+        error["error"]["results"] = results
+        return error
+
+    return response
 
 
 """
@@ -118,21 +679,56 @@ def handle_client(client_socket):
 
     try:
         while True:
-            data = client_socket.recv(4096)
-            if not data:
+            request = recv_request(client_socket)
+            if request is None:
                 break
-            request = json.loads(data.decode("utf-8"))
             response = {}
             if request["action"] == "ping":
-                response = {"status": "success"}
+                response = {
+                    "status": "success",
+                    "last_transaction": last_logged_transaction(),
+                }
             elif request["action"] == "trade":
                 response = process_trade(
-                    request["stock_name"], request["quantity"], request["order_type"]
+                    request["stock_name"],
+                    request["quantity"],
+                    request["order_type"],
+                    request.get("consistency"),
+                    request.get("idempotency_key"),
+                )
+            elif request["action"] == "trade_batch":
+                response = process_trade_batch(
+                    request["orders"],
+                    request.get("consistency"),
+                    request.get("idempotency_key"),
                 )
             elif request["action"] == "lookup":
                 response = get_order(request["order_number"])
             elif request["action"] == "get_newer_orders":
                 response = get_newer_orders(request["last_transaction"])
+            elif request["action"] == "stream_orders":
+                # answered with frames rather than one reply
+                stream_orders(
+                    client_socket,
+                    request["after"],
+                    request.get("page_size", catchup_page),
+                )
+                continue
+            elif request["action"] == "query_orders":
+                # answered with frames of matching orders
+                query_orders(client_socket, request)
+                continue
+            elif request["action"] == "send_snapshot":
+                send_snapshot(client_socket, request["format"])
+                continue
+            elif request["action"] == "replicate_stream":
+                # the connection now belongs to the leader's replication stream
+                serve_replication_stream(client_socket)
+                break
+            elif request["action"] == "stats":
+                response = get_stats(request)
+            elif request["action"] == "replication_status":
+                response = replication_status()
             elif request["action"] == "sync_order":
                 response = sync_order(
                     request["transaction_number"],
@@ -147,30 +743,37 @@ def handle_client(client_socket):
         client_socket.close()
 
 
+def recv_request(sock):
+    # batch requests can be bigger than a single recv
+    data = b""
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            if data:
+                raise ConnectionError("connection closed mid-request")
+            return None
+        data += chunk
+        try:
+            return json.loads(data.decode("utf-8"))
+        except ValueError:
+            continue  # request not complete yet
+
+
 def get_newer_orders(last_transaction):
     global next_transaction
 
-    newer_orders = []  # array to capture newer orders
-
-    if os.path.exists(order_file):
-        try:
-            with open(order_file, "r") as file:
-                reader = csv.reader(file)
-                next(reader)  # Skip header
-                for row in reader:
-                    if len(row) >= 4 and row[0].isdigit():
-                        transaction_num = int(row[0])
-                        if transaction_num > last_transaction:
-                            newer_orders.append(
-                                {
-                                    "transaction_number": transaction_num,
-                                    "stock_name": row[1],
-                                    "order_type": row[2],
-                                    "quantity": int(row[3]),
-                                }
-                            )
-        except Exception as e:
-            return {"status": "error", "error": f"Failed to read orders: {str(e)}"}
+    try:
+        newer_orders = [
+            {
+                "transaction_number": order["transaction_number"],
+                "stock_name": order["stock_name"],
+                "order_type": order["order_type"],
+                "quantity": order["quantity"],
+            }
+            for order in iter_orders_after(last_transaction)
+        ]
+    except Exception as e:
+        return {"status": "error", "error": f"Failed to read orders: {str(e)}"}
 
     return {"status": "success", "orders": newer_orders}
 
@@ -188,80 +791,300 @@ def sync_order(transaction_num, stock_name, order_type, quantity):
             return {"status": "already_processed"}
 
 
-def sync_with_replicas():
-    global next_transaction
-    last_transaction = -1
+def send_frame(sock, message):
+    payload = json.dumps(message).encode("utf-8")
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
 
-    # Find the last transaction we have
-    if os.path.exists(order_file):
-        try:
-            with open(order_file, "r") as file:
-                reader = csv.reader(file)
-                next(reader)  # Skip header
-                for row in reader:
-                    if row and len(row) > 0:
-                        try:
-                            transaction_num = int(
-                                row[0]
-                            )  # Initialize the transaction number
-                            last_transaction = max(last_transaction, transaction_num)
-                        except ValueError:
-                            pass
-        except Exception as e:
-            print(f"Error reading order log for sync: {e}")
 
-    # Get all replicas
-    orders_json_path = "orders.json"
-    if not os.path.exists(orders_json_path):
-        orders_json_path = "../frontend/orders.json"
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock):
+    # None if the connection closed before a whole frame arrived
+    header = recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    (size,) = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME:
+        raise ValueError(f"frame of {size} bytes is too large")
+    payload = recv_exactly(sock, size)
+    if payload is None:
+        return None
+    return json.loads(payload.decode("utf-8"))
+
 
+def stream_orders(sock, after, page_size):
+    # every order newer than after, page_size orders per frame; a page's
+    # cursor is the last transaction in it, so a dropped stream can resume
+    page = []
+    for order in iter_orders_after(after):
+        page.append(
+            [
+                order["transaction_number"],
+                order["stock_name"],
+                order["order_type"],
+                order["quantity"],
+                order["timestamp"],
+            ]
+        )
+        if len(page) >= page_size:
+            send_frame(sock, {"orders": page, "cursor": page[-1][0]})
+            page = []
+    cursor = page[-1][0] if page else after
+    send_frame(sock, {"orders": page, "cursor": cursor, "done": True})
+
+
+def query_orders(sock, request):
+    # orders in a stock (or all of them) logged between two timestamps,
+    # oldest first, in frames of up to catchup_page orders; the last frame
+    # says done. Only the orders that match are read from the log.
     try:
-        with open(orders_json_path, "r") as f:
-            replicas = json.load(f)
-    except FileNotFoundError:
+        stock_name = request.get("stock_name")
+        start = None if request.get("from") is None else float(request["from"])
+        end = None if request.get("to") is None else float(request["to"])
+        limit = None if request.get("limit") is None else int(request["limit"])
+        if (stock_name is not None and not isinstance(stock_name, str)) or (
+            limit is not None and limit < 0
+        ):
+            raise ValueError("bad query")
+    except (TypeError, ValueError):
+        send_frame(
+            sock, {"status": "error", "error": {"code": 400, "message": "invalid query"}}
+        )
+        return
+    index = order_queries
+    index.ready.wait()
+    page = []
+    found = 0
+    for order in read_orders(index.query(stock_name, start, end)):
+        if limit is not None and found >= limit:
+            break
+        timestamp = order["timestamp"] or 0.0
+        if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+            continue
+        page.append(
+            {
+                "number": order["transaction_number"],
+                "name": order["stock_name"],
+                "type": order["order_type"],
+                "quantity": order["quantity"],
+                "timestamp": order["timestamp"],
+            }
+        )
+        found += 1
+        if len(page) >= catchup_page:
+            send_frame(sock, {"orders": page})
+            page = []
+    send_frame(sock, {"orders": page, "done": True})
+
+
+def snapshot_files():
+    # (name, path, size) of every file making up the log right now; called
+    # with write_lock held, so the sizes on disk are whole writes. The log only
+    # grows at the end, so these byte ranges stay valid after we let go.
+    if order_log is None:
+        if not os.path.exists(order_file):
+            return []
+        return [("orders.csv", order_file, os.path.getsize(order_file))]
+    files = []
+    for first in order_log.segments:
+        for suffix in (".log", ".idx"):
+            path = order_log.path(first, suffix)
+            files.append((os.path.basename(path), path, os.path.getsize(path)))
+    return files
+
+
+def send_snapshot(sock, storage):
+    if storage != order_storage:
+        send_frame(
+            sock,
+            {
+                "status": "error",
+                "error": {"code": 409, "message": f"order log is stored as {order_storage}"},
+            },
+        )
         return
+    with write_lock:
+        last_transaction = last_logged_transaction()
+        files = snapshot_files()
+    send_frame(
+        sock,
+        {
+            "status": "success",
+            "last_transaction": last_transaction,
+            "files": [{"name": name, "size": size} for name, path, size in files],
+        },
+    )
+    for name, path, size in files:
+        with open(path, "rb") as f:
+            sock.sendfile(f, 0, size)
+
+
+def recv_into_file(sock, path, size):
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            chunk = sock.recv(min(remaining, 1 << 20))
+            if not chunk:
+                raise ConnectionError(f"snapshot ended {remaining} bytes short")
+            f.write(chunk)
+            remaining -= len(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def install_snapshot_from(replica):
+    # copy the peer's log files next to ours, then swap them in in one go
+    staging = (order_file if order_log is None else order_log_dir) + ".install"
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.settimeout(30)
+        sock.connect((replica["host"], replica["port"]))
+        request = {"action": "send_snapshot", "format": order_storage}
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        header = recv_frame(sock)
+        if header is None or header["status"] != "success":
+            print(f"Replica at {replica['host']}:{replica['port']} can't send a snapshot: {header}")
+            return False
+        start = time.time()
+        if order_log is None:
+            for file in header["files"]:
+                recv_into_file(sock, staging, file["size"])
+        else:
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(staging)
+            for file in header["files"]:
+                recv_into_file(sock, os.path.join(staging, file["name"]), file["size"])
+    install_snapshot(staging)
+    size = sum(file["size"] for file in header["files"])
+    print(
+        f"Installed snapshot up to {header['last_transaction']} ({size} bytes) from {replica['host']}:{replica['port']} in {time.time() - start:.2f}s"
+    )
+    return True
+
 
-    for replica in replicas:
+def install_snapshot(staging):
+    global next_transaction, order_log, order_handle, log_generation
+    with scribble_lock, write_lock:
+        log_generation += 1
+        if order_log is None:
+            if order_handle is not None:
+                order_handle.close()
+                order_handle = None
+            os.replace(staging, order_file)
+            build_order_index()
+            index_ready.set()
+            write_checkpoint(os.path.getsize(order_file))
+        else:
+            order_log.close()
+            retired = order_log_dir + ".old"
+            shutil.rmtree(retired, ignore_errors=True)
+            if os.path.exists(order_log_dir):
+                os.rename(order_log_dir, retired)
+            os.rename(staging, order_log_dir)
+            shutil.rmtree(retired, ignore_errors=True)
+            order_log = SegmentLog(order_log_dir, segment_bytes)
+        next_transaction = max(next_transaction, last_logged_transaction() + 1)
+        init_order_queries()
+
+
+def ping_replica(replica):
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.settimeout(2)
+            sock.connect((replica["host"], replica["port"]))
+            sock.sendall(json.dumps({"action": "ping"}).encode("utf-8"))
+            return json.loads(sock.recv(4096).decode("utf-8"))
+    except Exception:
+        return None
+
+
+def apply_orders(orders, after=None):
+    # after: the sender's transaction right before these orders, if we might
+    # not have it. Returns how many orders were new, or None (and logs
+    # nothing) if we are missing orders from before them.
+    global next_transaction
+    with scribble_lock:
+        if after is not None and after > last_logged_transaction():
+            return None
+        fresh = [order for order in orders if order[0] > last_logged_transaction()]
+        if not fresh:
+            return 0
+        log_orders([order[:5] if order[4] is not None else order[:4] for order in fresh])
+        for order in fresh:
+            if len(order) > 5:
+                dedup_table.remember(*order[5])
+        next_transaction = max(next_transaction, fresh[-1][0] + 1)
+    return len(fresh)
+
+
+def catch_up_from(replica):
+    # stream everything newer than our log from one replica, page by page
+    synced = 0
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.settimeout(5)  # Set timeout value
+        sock.connect((replica["host"], replica["port"]))
+        request = {
+            "action": "stream_orders",
+            "after": last_logged_transaction(),
+            "page_size": catchup_page,
+        }
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        while True:
+            frame = recv_frame(sock)
+            if frame is None:
+                raise ConnectionError(f"stream ended after {synced} orders")
+            synced += apply_orders(frame["orders"])
+            if frame.get("done"):
+                return synced
+
+
+def sync_with_replicas():
+    for replica in load_replicas():
         # Skip current replica
         if replica["port"] == server_port:
             continue
 
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(5)  # Set timeout value
-                sock.connect((replica["host"], replica["port"]))
-                request = {
-                    "action": "get_newer_orders",
-                    "last_transaction": last_transaction,
-                }
-                sock.sendall(json.dumps(request).encode("utf-8"))
-
-                response = sock.recv(4096)
-                response_data = json.loads(response.decode("utf-8"))
-
-                if response_data["status"] == "success" and "orders" in response_data:
-                    for order in response_data["orders"]:
-                        with scribble_lock:
-                            if order["transaction_number"] >= next_transaction:
-                                next_transaction = order["transaction_number"] + 1
-                            save_order(
-                                order["transaction_number"],
-                                order["stock_name"],
-                                order["order_type"],
-                                order["quantity"],
-                            )
-                    print(
-                        f"Synced {len(response_data['orders'])} orders from replica at {replica['host']}:{replica['port']}"
-                    )
+        # far behind: take the peer's log files wholesale, then stream the rest
+        ping = ping_replica(replica)
+        if ping is None:
+            print(f"Replica at {replica['host']}:{replica['port']} is not reachable")
+            continue
+        behind = ping.get("last_transaction", -1) - last_logged_transaction()
+        if behind >= snapshot_threshold:
+            try:
+                install_snapshot_from(replica)
+            except Exception as e:
+                print(
+                    f"Failed to install snapshot from replica at {replica['host']}:{replica['port']}: {e}"
+                )
 
-                    # If we got orders, we can not check other details.
-                    if response_data["orders"]:
-                        break
+        synced = 0
+        for attempt in range(catchup_attempts):
+            start = time.time()
+            try:
+                synced = catch_up_from(replica)
+                print(
+                    f"Synced {synced} orders from replica at {replica['host']}:{replica['port']} in {time.time() - start:.2f}s"
+                )
+                break
+            except Exception as e:
+                # whatever was applied stays, the next attempt resumes after it
+                print(
+                    f"Failed to sync with replica at {replica['host']}:{replica['port']}: {e}"
+                )
+                if isinstance(e, ConnectionRefusedError):
+                    break
 
-        except Exception as e:
-            print(
-                f"Failed to sync with replica at {replica['host']}:{replica['port']}: {e}"
-            )
+        # If we got orders, we can not check other details.
+        if synced:
+            break
 
 
 """
@@ -269,89 +1092,463 @@ End AI-assisted code piece
 """
 
 
-def init_txn_ctr():
-    global next_transaction
+def scan_order_log(start=0, end=None):
+    # {transaction number: offset} for the rows between the two offsets
+    index = {}
+    with open(order_file, "rb") as file:
+        file.seek(start)
+        if start == 0:
+            start = len(file.readline())  # Skip header
+        offset = start
+        for line in file:
+            if end is not None and offset >= end:
+                break
+            transaction_num = line.split(b",", 1)[0]
+            if transaction_num.isdigit():
+                index[int(transaction_num)] = offset
+            offset += len(line)
+    return index
+
+
+def build_order_index():
+    global order_index, last_logged
+    order_index = {}
     if os.path.exists(order_file):
         try:
-            with open(order_file, "r") as file:
-                reader = csv.reader(file)
-                next(reader)
-                max_transaction = -1
-                for row in reader:
-                    if row and len(row) > 0:
-                        try:
-                            transaction_num = int(row[0])
-                            max_transaction = max(max_transaction, transaction_num)
-                        except ValueError:
-                            pass
-                next_transaction = max_transaction + 1
+            order_index = scan_order_log()
         except Exception as e:
             print(f"Error reading order log: {e}")
-            next_transaction = 0
+    last_logged = max(order_index, default=-1)
+
+
+def line_before(offset):
+    # the last full line of order_file ending at offset
+    with open(order_file, "rb") as file:
+        start = max(0, offset - 4096)
+        file.seek(start)
+        data = file.read(offset - start)
+    return data.rstrip(b"\r\n").rsplit(b"\n", 1)[-1]
+
+
+def write_checkpoint(offset):
+    global unchecked_orders
+    checkpoint = {
+        "last_transaction": last_logged,
+        "offset": offset,
+        "crc": zlib.crc32(line_before(offset)),
+    }
+    temp_file = checkpoint_file + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_file, checkpoint_file)
+    unchecked_orders = 0
+
+
+def load_checkpoint():
+    # None unless the checkpoint still matches the log it was taken from
+    try:
+        with open(checkpoint_file, "r") as f:
+            checkpoint = json.load(f)
+        if os.path.getsize(order_file) < checkpoint["offset"]:
+            return None
+        if zlib.crc32(line_before(checkpoint["offset"])) != checkpoint["crc"]:
+            return None
+        return checkpoint
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def index_history(end, generation):
+    try:
+        history = scan_order_log(0, end)
+    except Exception as e:
+        print(f"Error reading order log: {e}")
+        history = {}
+    # install_snapshot swaps the file and the index under scribble_lock
+    with scribble_lock:
+        if generation != log_generation:
+            print(f"Dropped history index of a replaced {order_file}")
+            return
+        # merge into the live index, which the log writer keeps adding to
+        for transaction_num, offset in history.items():
+            order_index.setdefault(transaction_num, offset)
+    index_ready.set()
+    print(f"Indexed {len(order_index)} orders from {order_file}")
+
+
+def init_order_index():
+    global order_index, last_logged
+    checkpoint = load_checkpoint()
+    if checkpoint is None:
+        build_order_index()
+        index_ready.set()
+        print(f"Indexed {len(order_index)} orders from {order_file}")
+        if order_index:
+            write_checkpoint(os.path.getsize(order_file))
+        return
+    # only the tail after the checkpoint is needed to start serving; older
+    # rows are indexed in the background
+    order_index = scan_order_log(checkpoint["offset"])
+    last_logged = max(checkpoint["last_transaction"], max(order_index, default=-1))
+    print(
+        f"Resumed {order_file} from checkpoint at {checkpoint['last_transaction']}"
+        f" (+{len(order_index)} orders)"
+    )
+    threading.Thread(
+        target=index_history, args=(checkpoint["offset"], log_generation), daemon=True
+    ).start()
+
+
+def open_order_log():
+    global order_log
+    segment_log = SegmentLog(order_log_dir, segment_bytes)
+    if segment_log.last_transaction < 0 and os.path.exists(order_file):
+        # first start on segments: carry over the csv history
+        build_order_index()
+        index_ready.set()
+        # rows from before timestamps were logged get 0, like in the indexes
+        segment_log.append(
+            (order["transaction_number"], order["stock_name"], order["order_type"],
+             order["quantity"], order["timestamp"] or 0.0)
+            for order in iter_orders_after(-1)
+        )
+        print(f"Imported orders up to {segment_log.last_transaction} from {order_file}")
+    order_log = segment_log
+
+
+def init_txn_ctr():
+    global next_transaction
+    if order_storage == "segments":
+        open_order_log()
     else:
-        next_transaction = 0
+        init_order_index()
+    next_transaction = last_logged_transaction() + 1
+    init_order_queries()
+
+
+def init_order_queries():
+    # new orders are indexed and counted as they are logged; everything logged
+    # so far is read in the background and put in front of them
+    global order_queries, order_stats
+    order_queries = SecondaryIndex(last_logged_transaction())
+    order_stats = TradeStats(stats_minutes, last_logged_transaction())
+    threading.Thread(
+        target=index_query_history,
+        args=(order_queries, order_stats, last_logged_transaction()),
+        daemon=True,
+    ).start()
+
+
+def index_query_history(index, stats, until):
+    history = SecondaryIndex()
+    history_stats = TradeStats(stats_minutes)
+    try:
+        for order in iter_orders_after(-1):
+            if order["transaction_number"] > until:
+                break
+            history.add(order["transaction_number"], order["stock_name"], order["timestamp"])
+            history_stats.add(
+                order["transaction_number"],
+                order["stock_name"],
+                order["order_type"],
+                order["quantity"],
+                order["timestamp"],
+            )
+    except Exception as e:
+        print(f"Error indexing order history: {e}")
+    index.prepend(history)
+    stats.merge(history_stats)
+    print(f"Indexed {len(history.everything[0])} orders for queries")
+
+
+def get_stats(request):
+    stock_name = request.get("stock_name")
+    minutes = request.get("minutes")
+    if (stock_name is not None and not isinstance(stock_name, str)) or (
+        minutes is not None and (not isinstance(minutes, int) or minutes < 0)
+    ):
+        return {"status": "error", "error": {"code": 400, "message": "invalid stats request"}}
+    stats = order_stats
+    stats.ready.wait()
+    return {
+        "status": "success",
+        "data": {
+            "stocks": stats.snapshot(time.time(), stock_name, minutes),
+            "last_transaction": last_logged_transaction(),
+        },
+    }
 
 
 def get_order(order_num):
-    if not os.path.exists(order_file):
+    record = lookup_order_record(order_num)
+    if record is None:
         return {"status": "error", "error": {"code": 404, "message": "Order not found"}}
-    file = open(order_file, "r", newline="")
-    reader = csv.reader(file)
-    next(reader)  # Skip header
-    for row in reader:
-        if len(row) >= 4 and row[0].isdigit() and int(row[0]) == order_num:
-            return {
-                "status": "success",
-                "data": {
-                    "number": int(row[0]),
-                    "name": row[1],
-                    "type": row[2],
-                    "quantity": int(row[3]),
-                },
-            }
-
-    file.close()
     return {
-        "status": "error",
-        "error": {"code": 404, "message": "Order not found"},
+        "status": "success",
+        "data": {
+            "number": record["transaction_number"],
+            "name": record["stock_name"],
+            "type": record["order_type"],
+            "quantity": record["quantity"],
+        },
     }
 
 
-def propagate_to_followers(transaction_num, stock_name, order_type, quantity):
-    # Read replicas configuration
-    try:
+replicas = None  # orders.json, read once
+
+
+def load_replicas():
+    global replicas
+    if replicas is None:
         orders_json_path = "orders.json"
         if not os.path.exists(orders_json_path):
             orders_json_path = "../frontend/orders.json"
+        try:
+            with open(orders_json_path, "r") as f:
+                replicas = json.load(f)
+        except Exception as e:
+            print(f"Failed to read replicas: {e}")
+            return []
+    return replicas
 
-        with open(orders_json_path, "r") as f:
-            replicas = json.load(f)
-    except Exception as e:
-        print(f"Failed to read replicas: {e}")
-        return
 
-    for replica in replicas:
-        # Skip current replica
-        if replica["port"] == server_port:
-            continue
+class ReplicationStream:
+    # Ships the leader's new orders to one follower over a long-lived
+    # connection. Trades only queue their order; a background thread sends
+    # whatever has piled up as one numbered frame, without waiting for the
+    # previous frame's ack. The follower acks each frame with the last
+    # transaction it has logged, so acks are cumulative. Each frame also says
+    # which transaction it follows, and a follower that doesn't have that one
+    # rejects the frame; the stream then reconnects. After a reconnect, or
+    # when the in-memory queue overflowed, the missing orders are re-read from
+    # the log.
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.pending = collections.deque()
+        self.ready = threading.Condition()
+        self.sock = None
+        self.seq = 0  # frames sent on the current connection
+        self.acked_seq = 0  # frames acknowledged on the current connection
+        self.sent = -1  # last transaction sent to the follower
+        self.acked = -1  # last transaction the follower has logged
+        self.last_ack = None  # time of the last acknowledgement
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def queue(self, orders):
+        with self.ready:
+            self.pending.extend(orders)
+            while len(self.pending) > replication_queue_limit:
+                self.pending.popleft()
+            self.ready.notify_all()
 
+    def run(self):
+        while True:
+            if self.sock is None and not self.connect():
+                time.sleep(1)
+                continue
+            with self.ready:
+                while not self.pending and self.sock is not None:
+                    self.ready.wait()
+                batch = []
+                while self.pending and len(batch) < catchup_page:
+                    order = self.pending.popleft()
+                    if order[0] > self.sent:
+                        batch.append(order)
+                if batch and self.sock is None:
+                    self.keep(batch)
+                    continue
+            if not batch:
+                continue
+            try:
+                if batch[0][0] > self.sent + 1:
+                    self.backfill(batch[0][0] - 1)
+                self.send(batch)
+            except Exception as e:
+                print(f"Replication to {self.host}:{self.port} failed: {e}")
+                self.keep(batch)
+                self.close()
+
+    def keep(self, batch):
+        # put a batch that didn't go out back in front, for after the
+        # reconnect; whatever the follower already has is skipped then
+        with self.ready:
+            self.pending.extendleft(reversed(batch))
+
+    def connect(self):
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(2)
-                sock.connect((replica["host"], replica["port"]))
-                request = {
-                    "action": "sync_order",
-                    "transaction_number": transaction_num,
-                    "stock_name": stock_name,
-                    "order_type": order_type,
-                    "quantity": quantity,
-                }
-                sock.sendall(json.dumps(request).encode("utf-8"))
-                #No response wait here
+            sock = socket.create_connection((self.host, self.port), timeout=2)
+            sock.sendall(json.dumps({"action": "replicate_stream"}).encode("utf-8"))
+            reply = recv_frame(sock)
+            if reply is None or reply["status"] != "success":
+                raise ConnectionError("no handshake")
+            sock.settimeout(None)
+        except Exception:
+            return False
+        with self.ready:
+            self.sock = sock
+            self.seq = 0
+            self.acked_seq = 0
+            self.sent = reply["last_transaction"]
+            self.acked = reply["last_transaction"]
+        print(f"Replication stream to {self.host}:{self.port} open at {self.sent}")
+        threading.Thread(target=self.read_acks, args=(sock,), daemon=True).start()
+        # send whatever the follower is missing from before this connection
+        try:
+            self.backfill(last_logged_transaction())
         except Exception as e:
-            print(
-                f"Failed to propagate order to replica at {replica['host']}:{replica['port']}: {e}"
+            print(f"Replication to {self.host}:{self.port} failed: {e}")
+            self.close()
+            return False
+        return True
+
+    def backfill(self, until):
+        batch = []
+        for order in iter_orders_after(self.sent):
+            if order["transaction_number"] > until:
+                break
+            batch.append(
+                (
+                    order["transaction_number"],
+                    order["stock_name"],
+                    order["order_type"],
+                    order["quantity"],
+                    order["timestamp"],
+                )
             )
+            if len(batch) >= catchup_page:
+                self.send(batch)
+                batch = []
+        if batch:
+            self.send(batch)
+
+    def send(self, batch):
+        with self.ready:
+            # wait for room in the window, so a slow follower only ever holds
+            # up this thread
+            while self.seq - self.acked_seq >= replication_window and self.sock is not None:
+                self.ready.wait()
+            if self.sock is None:
+                raise ConnectionError("stream closed")
+            self.seq += 1
+            seq = self.seq
+            sock = self.sock
+        frame = {"seq": seq, "after": self.sent, "orders": [list(order) for order in batch]}
+        send_frame(sock, frame)
+        self.sent = batch[-1][0]
+
+    def read_acks(self, sock):
+        while True:
+            try:
+                frame = recv_frame(sock)
+            except Exception:
+                frame = None
+            with self.ready:
+                if self.sock is not sock:
+                    return
+                if frame is None or frame.get("rejected"):
+                    if frame is not None:
+                        # the follower is missing orders from before that
+                        # frame; the reconnect backfills them from its ack
+                        print(
+                            f"Follower {self.host}:{self.port} is at {frame['ack']}, reconnecting"
+                        )
+                    self.sock = None
+                    self.ready.notify_all()
+                    sock.close()
+                    return
+                self.acked_seq = frame["seq"]
+                self.acked = max(self.acked, frame["ack"])
+                self.last_ack = time.time()
+                self.ready.notify_all()
+            with acks_changed:
+                acks_changed.notify_all()
+
+    def close(self):
+        with self.ready:
+            if self.sock is not None:
+                self.sock.close()
+            self.sock = None
+            self.ready.notify_all()
+
+    def status(self):
+        leader_last = last_logged_transaction()
+        return {
+            "host": self.host,
+            "port": self.port,
+            "connected": self.sock is not None,
+            "acked": self.acked,
+            "lag": max(0, leader_last - self.acked),
+            "last_ack": self.last_ack,
+        }
+
+
+replication_streams = {}  # follower port -> ReplicationStream, opened by the leader
+replication_lock = threading.Lock()
+
+
+def follower_streams():
+    with replication_lock:
+        if not replication_streams:
+            for replica in load_replicas():
+                if replica["port"] != server_port:
+                    replication_streams[replica["port"]] = ReplicationStream(
+                        replica["host"], replica["port"]
+                    )
+        return list(replication_streams.values())
+
+
+def propagate_to_followers(orders):
+    for stream in follower_streams():
+        stream.queue(orders)
+
+
+def followers_needed(consistency):
+    followers = len([r for r in load_replicas() if r["port"] != server_port])
+    if consistency == "all":
+        return followers
+    if consistency == "quorum":
+        # a majority of all replicas, the leader included
+        return (followers + 1) // 2
+    return 0
+
+
+def wait_for_acks(transaction_num, needed):
+    # every follower stream acks on its own, so this returns as soon as the
+    # fastest `needed` of them have logged the trade
+    if needed == 0:
+        return 0
+    streams = follower_streams()
+    deadline = time.monotonic() + ack_timeout
+    with acks_changed:
+        while True:
+            acked = sum(1 for stream in streams if stream.acked >= transaction_num)
+            remaining = deadline - time.monotonic()
+            if acked >= needed or remaining <= 0:
+                return acked
+            acks_changed.wait(remaining)
+
+
+def replication_status():
+    with replication_lock:
+        streams = list(replication_streams.values())
+    return {"status": "success", "followers": [stream.status() for stream in streams]}
+
+
+def serve_replication_stream(sock):
+    # follower side: log each frame and ack it with our last transaction; a
+    # frame that would leave a gap is rejected, so the ack never covers
+    # orders we don't have
+    send_frame(sock, {"status": "success", "last_transaction": last_logged_transaction()})
+    while True:
+        frame = recv_frame(sock)
+        if frame is None:
+            return
+        applied = apply_orders(frame["orders"], frame.get("after", -1))
+        reply = {"seq": frame["seq"], "ack": last_logged_transaction()}
+        if applied is None:
+            reply["rejected"] = True
+        send_frame(sock, reply)
 
 
 def start_serve():
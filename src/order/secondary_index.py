@@ -0,0 +1,65 @@
+import bisect
+import threading
+from array import array
+
+# Secondary indexes over the order log, used by order.py's query_orders. For
+# every stock, and for the log as a whole, the index keeps the transaction
+# numbers in log order next to their timestamps, so a time range is two
+# bisects. Orders are logged in transaction order and stamped by the leader as
+# it numbers them, so their timestamps are already (nearly) sorted; a timestamp
+# lower than the one before it is indexed as that earlier one, which keeps the
+# arrays sorted. Callers check the real timestamps of what they read back.
+
+
+def empty_postings():
+    return array("q"), array("d")  # transaction numbers, timestamps
+
+
+class SecondaryIndex:
+    # Orders must be added in increasing transaction order (order.py adds them
+    # from the log writer thread). Queries can run alongside.
+    def __init__(self, after=-1):
+        self.last_transaction = after  # orders up to here are left to prepend
+        self.latest = 0.0  # highest timestamp indexed
+        self.by_stock = {}  # stock name -> postings
+        self.everything = empty_postings()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()  # set once the history is prepended
+
+    def add(self, transaction_num, stock_name, timestamp):
+        if transaction_num <= self.last_transaction:
+            return
+        timestamp = max(timestamp or 0.0, self.latest)
+        with self.lock:
+            for txns, times in (
+                self.everything,
+                self.by_stock.setdefault(stock_name, empty_postings()),
+            ):
+                txns.append(transaction_num)
+                times.append(timestamp)
+            self.last_transaction = transaction_num
+            self.latest = timestamp
+
+    def prepend(self, history):
+        # history: an index of everything logged before this one started
+        with self.lock:
+            for stock_name, (txns, times) in history.by_stock.items():
+                live_txns, live_times = self.by_stock.get(stock_name, empty_postings())
+                self.by_stock[stock_name] = (txns + live_txns, times + live_times)
+            self.everything = (
+                history.everything[0] + self.everything[0],
+                history.everything[1] + self.everything[1],
+            )
+        self.ready.set()
+
+    def query(self, stock_name=None, start=None, end=None):
+        # transaction numbers of the orders (in stock_name) indexed between
+        # the two timestamps, oldest first
+        with self.lock:
+            if stock_name is None:
+                txns, times = self.everything
+            else:
+                txns, times = self.by_stock.get(stock_name, empty_postings())
+            low = 0 if start is None else bisect.bisect_left(times, start)
+            high = len(times) if end is None else bisect.bisect_right(times, end)
+            return txns[low:high]
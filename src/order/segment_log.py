@@ -0,0 +1,197 @@
+import bisect
+import os
+import struct
+
+# Segmented binary order log, used by order.py when ORDER_STORAGE=segments.
+# The log is a directory of segment files named after the first transaction
+# they hold (00000000000000000042.log). Each segment is a run of binary records
+# and rolls over once it reaches segment_bytes. Next to each segment, a .idx
+# file holds a sparse (transaction number, offset) entry every index_interval
+# bytes. A lookup therefore reads one small index and a few records of one
+# segment, and startup only has to read the last segment.
+
+RECORD_HEADER = struct.Struct("<qdBIH")  # txn, timestamp, type, quantity, name length
+INDEX_ENTRY = struct.Struct("<qQ")  # txn, offset of its record in the segment
+ORDER_TYPES = ["buy", "sell"]
+
+
+def read_record(file):
+    # None at the end of the segment, including a torn record left by a crash
+    header = file.read(RECORD_HEADER.size)
+    if len(header) < RECORD_HEADER.size:
+        return None
+    transaction_num, timestamp, order_type, quantity, name_length = RECORD_HEADER.unpack(header)
+    name = file.read(name_length)
+    if len(name) < name_length:
+        return None
+    return {
+        "transaction_number": transaction_num,
+        "stock_name": name.decode("utf-8"),
+        "order_type": ORDER_TYPES[order_type],
+        "quantity": quantity,
+        "timestamp": timestamp,
+    }
+
+
+def pack_record(transaction_num, stock_name, order_type, quantity, timestamp):
+    name = stock_name.encode("utf-8")
+    header = RECORD_HEADER.pack(
+        transaction_num, timestamp, ORDER_TYPES.index(order_type), quantity, len(name)
+    )
+    return header + name
+
+
+class SegmentLog:
+    # Appends must come in increasing transaction order and from one thread at
+    # a time (order.py's log writer). Reads can run alongside them.
+    def __init__(self, directory, segment_bytes=4 << 20, index_interval=4096):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(
+            int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log")
+        )
+        self.indexes = {}  # first txn -> ([txns], [offsets]), loaded on first use
+        self.log_handle = None
+        self.index_handle = None
+        self.active_size = 0
+        self.last_indexed = None  # offset of the active segment's last index entry
+        self.last_transaction = -1
+        self.recover_active()
+
+    def path(self, first, suffix):
+        return os.path.join(self.directory, f"{first:020d}{suffix}")
+
+    def load_index(self, first):
+        if first not in self.indexes:
+            txns, offsets = [], []
+            try:
+                with open(self.path(first, ".idx"), "rb") as f:
+                    data = f.read()
+                usable = len(data) - len(data) % INDEX_ENTRY.size
+                for txn, offset in INDEX_ENTRY.iter_unpack(data[:usable]):
+                    txns.append(txn)
+                    offsets.append(offset)
+            except FileNotFoundError:
+                pass
+            self.indexes[first] = (txns, offsets)
+        return self.indexes[first]
+
+    def recover_active(self):
+        # read the tail of the last segment from its last index entry on, and
+        # cut off anything a crash left half written
+        while self.segments:
+            first = self.segments[-1]
+            log_path = self.path(first, ".log")
+            size = os.path.getsize(log_path)
+            txns, offsets = self.load_index(first)
+            while offsets and offsets[-1] >= size:
+                txns.pop()
+                offsets.pop()
+            start = offsets[-1] if offsets else 0
+            with open(log_path, "rb") as f:
+                f.seek(start)
+                end = start
+                while True:
+                    record = read_record(f)
+                    if record is None:
+                        break
+                    self.last_transaction = record["transaction_number"]
+                    end = f.tell()
+            if end == 0:
+                # rolled over but never written to
+                os.remove(log_path)
+                if os.path.exists(self.path(first, ".idx")):
+                    os.remove(self.path(first, ".idx"))
+                self.segments.pop()
+                del self.indexes[first]
+                continue
+            if end < size:
+                print(f"Truncating torn order record at {log_path}:{end}")
+                os.truncate(log_path, end)
+            with open(self.path(first, ".idx"), "wb") as f:
+                f.writelines(INDEX_ENTRY.pack(t, o) for t, o in zip(txns, offsets))
+            self.log_handle = open(log_path, "ab")
+            self.index_handle = open(self.path(first, ".idx"), "ab")
+            self.active_size = end
+            self.last_indexed = offsets[-1] if offsets else None
+            return
+
+    def roll(self, first):
+        if self.log_handle is not None:
+            self.log_handle.close()
+            self.index_handle.close()
+        self.log_handle = open(self.path(first, ".log"), "ab")
+        self.index_handle = open(self.path(first, ".idx"), "ab")
+        self.indexes[first] = ([], [])
+        self.segments.append(first)
+        self.active_size = 0
+        self.last_indexed = None
+
+    def append(self, records):
+        # records: (txn, stock name, order type, quantity, timestamp) tuples
+        for record in records:
+            transaction_num = record[0]
+            if transaction_num <= self.last_transaction:
+                continue
+            data = pack_record(*record)  # before anything is written for it
+            if self.log_handle is None or self.active_size >= self.segment_bytes:
+                self.roll(transaction_num)
+            if self.last_indexed is None or self.active_size - self.last_indexed >= self.index_interval:
+                self.index_handle.write(INDEX_ENTRY.pack(transaction_num, self.active_size))
+                txns, offsets = self.indexes[self.segments[-1]]
+                txns.append(transaction_num)
+                offsets.append(self.active_size)
+                self.last_indexed = self.active_size
+            self.log_handle.write(data)
+            self.active_size += len(data)
+            self.last_transaction = transaction_num
+        if self.log_handle is not None:
+            # records must reach the file before index entries pointing at them
+            self.log_handle.flush()
+            self.index_handle.flush()
+
+    def sync(self):
+        if self.log_handle is not None:
+            os.fsync(self.log_handle.fileno())
+
+    def seek_position(self, transaction_num):
+        # (segment, offset) to start reading from to find transaction_num
+        slot = bisect.bisect_right(self.segments, transaction_num) - 1
+        if slot < 0:
+            return 0, 0
+        txns, offsets = self.load_index(self.segments[slot])
+        entry = bisect.bisect_right(txns, transaction_num) - 1
+        return slot, offsets[entry] if entry >= 0 else 0
+
+    def lookup(self, transaction_num):
+        if transaction_num > self.last_transaction:
+            return None
+        record = next(self.iter_from(transaction_num), None)
+        if record is not None and record["transaction_number"] == transaction_num:
+            return record
+        return None
+
+    def iter_from(self, transaction_num):
+        # records with a transaction number >= transaction_num, in order
+        segments = list(self.segments)
+        if not segments:
+            return
+        slot, offset = self.seek_position(transaction_num)
+        for first in segments[slot:]:
+            with open(self.path(first, ".log"), "rb") as f:
+                f.seek(offset)
+                while True:
+                    record = read_record(f)
+                    if record is None:
+                        break
+                    if record["transaction_number"] >= transaction_num:
+                        yield record
+            offset = 0
+
+    def close(self):
+        if self.log_handle is not None:
+            self.log_handle.close()
+            self.index_handle.close()
+            self.log_handle = None
@@ -0,0 +1,84 @@
+import threading
+
+# Running per-stock trade aggregates, used by order.py's stats action. Every
+# logged order updates its stock's totals and the bucket for the minute it was
+# placed in, in constant time. The buckets of a stock form a ring of
+# window_minutes slots: a slot still holding an older minute is reset when a
+# newer minute comes around to it.
+
+
+class TradeStats:
+    def __init__(self, window_minutes=60, after=-1):
+        self.window = window_minutes
+        self.last_transaction = after  # orders up to here are left to merge
+        self.totals = {}  # stock name -> [orders, buys, sells, bought, sold]
+        self.buckets = {}  # stock name -> ring of [minute, orders, bought, sold]
+        self.lock = threading.Lock()
+        self.ready = threading.Event()  # set once the history is merged in
+
+    def add(self, transaction_num, stock_name, order_type, quantity, timestamp):
+        if transaction_num <= self.last_transaction:
+            return
+        minute = int(timestamp or 0) // 60
+        buy = order_type == "buy"
+        with self.lock:
+            totals = self.totals.get(stock_name)
+            if totals is None:
+                totals = self.totals[stock_name] = [0, 0, 0, 0, 0]
+                self.buckets[stock_name] = [[-1, 0, 0, 0] for _ in range(self.window)]
+            totals[0] += 1
+            totals[1 if buy else 2] += 1
+            totals[3 if buy else 4] += quantity
+            bucket = self.buckets[stock_name][minute % self.window]
+            if bucket[0] < minute:
+                bucket[:] = [minute, 0, 0, 0]
+            if bucket[0] == minute:
+                bucket[1] += 1
+                bucket[2 if buy else 3] += quantity
+            self.last_transaction = transaction_num
+
+    def merge(self, history):
+        # history: stats of everything logged before these started
+        with self.lock:
+            for stock_name, totals in history.totals.items():
+                if stock_name not in self.totals:
+                    self.totals[stock_name] = list(totals)
+                    self.buckets[stock_name] = [list(b) for b in history.buckets[stock_name]]
+                    continue
+                mine = self.totals[stock_name]
+                for i, value in enumerate(totals):
+                    mine[i] += value
+                for bucket, older in zip(self.buckets[stock_name], history.buckets[stock_name]):
+                    if bucket[0] < older[0]:
+                        bucket[:] = older
+                    elif bucket[0] == older[0]:
+                        for i in range(1, 4):
+                            bucket[i] += older[i]
+        self.ready.set()
+
+    def snapshot(self, now, stock_name=None, minutes=None):
+        # {stock: totals and the non-empty buckets of the last `minutes`
+        # minutes (at most the window), oldest first}
+        minutes = self.window if minutes is None else min(minutes, self.window)
+        oldest = int(now) // 60 - minutes + 1
+        names = self.totals if stock_name is None else [stock_name]
+        stats = {}
+        with self.lock:
+            for name in names:
+                if name not in self.totals:
+                    continue
+                orders, buys, sells, bought, sold = self.totals[name]
+                recent = sorted(b for b in self.buckets[name] if b[0] >= oldest)
+                stats[name] = {
+                    "orders": orders,
+                    "buys": buys,
+                    "sells": sells,
+                    "bought": bought,
+                    "sold": sold,
+                    "net_flow": bought - sold,
+                    "minutes": [
+                        {"minute": m * 60, "orders": n, "bought": b, "sold": s}
+                        for m, n, b, s in recent
+                    ],
+                }
+        return stats
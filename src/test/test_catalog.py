@@ -120,12 +120,125 @@ def test_insufficient_quantity():
         print("✓ Test passed: Insufficient quantity returns error")
 
 
+def test_lookup_many():
+    print("\nTest: Looking up several stocks in one request")
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.connect(("localhost", 6666))
+        request = {
+            "action": "lookup_many",
+            "stock_names": ["GameStart", "NonExistentStock", "BoarCo"],
+        }
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        response = sock.recv(4096)
+        result = json.loads(response.decode("utf-8"))
+
+        print(f"Response: {result}")
+        assert result["status"] == "success", "Expected success status"
+        names = [entry["name"] for entry in result["data"]]
+        assert names == ["GameStart", "BoarCo"], "Expected found stocks in request order"
+        assert result["errors"]["NonExistentStock"]["code"] == 404, (
+            "Expected 404 error for the unknown stock"
+        )
+        print("✓ Test passed: Batched lookup successful")
+
+
+def test_changes_since():
+    print("\nTest: Fetching changes since a catalog version")
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.connect(("localhost", 6666))
+        request = {"action": "lookup", "stock_name": "CaesarTech"}
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        before = json.loads(sock.recv(4096).decode("utf-8"))["data"]["version"]
+
+        request = {"action": "update", "stock_name": "CaesarTech", "quantity_change": -1}
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        updated = json.loads(sock.recv(4096).decode("utf-8"))
+        assert updated["data"]["version"] > before, "Expected the version to increase"
+
+        request = {"action": "changes_since", "version": updated["data"]["version"] - 1}
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        result = json.loads(sock.recv(4096).decode("utf-8"))
+
+        print(f"Response: {result}")
+        assert result["status"] == "success", "Expected success status"
+        assert result["version"] >= updated["data"]["version"], "Expected current version"
+        assert "CaesarTech" in [entry["name"] for entry in result["data"]], (
+            "Expected the updated stock among the changes"
+        )
+        print("✓ Test passed: Changes since version returned")
+
+        # Reset the quantity (put it back)
+        request = {"action": "update", "stock_name": "CaesarTech", "quantity_change": 1}
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        sock.recv(4096)
+
+
+def test_update_many():
+    print("\nTest: Atomic basket update")
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.connect(("localhost", 6666))
+        request = {"action": "lookup_many", "stock_names": ["Reneium", "PiloteCo"]}
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        before = json.loads(sock.recv(4096).decode("utf-8"))["data"]
+        reneium, pilote = before[0]["quantity"], before[1]["quantity"]
+
+        # One leg can't be filled, so nothing may change
+        request = {
+            "action": "update_many",
+            "legs": [
+                {"stock_name": "Reneium", "quantity_change": -1},
+                {"stock_name": "PiloteCo", "quantity_change": -(pilote + 1)},
+            ],
+        }
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        result = json.loads(sock.recv(4096).decode("utf-8"))
+        print(f"Response: {result}")
+        assert result["status"] == "error", "Expected error status"
+        assert result["error"]["stock_name"] == "PiloteCo", "Expected the failing leg"
+
+        request = {"action": "lookup", "stock_name": "Reneium"}
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        result = json.loads(sock.recv(4096).decode("utf-8"))
+        assert result["data"]["quantity"] == reneium, "Expected no partial fill"
+
+        request = {
+            "action": "update_many",
+            "legs": [
+                {"stock_name": "Reneium", "quantity_change": -1},
+                {"stock_name": "PiloteCo", "quantity_change": -1},
+            ],
+        }
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        result = json.loads(sock.recv(4096).decode("utf-8"))
+        print(f"Response: {result}")
+        assert result["status"] == "success", "Expected success status"
+        assert [entry["quantity"] for entry in result["data"]] == [reneium - 1, pilote - 1]
+        print("✓ Test passed: Basket update is all-or-nothing")
+
+        # Reset the quantities (put them back)
+        request = {
+            "action": "update_many",
+            "legs": [
+                {"stock_name": "Reneium", "quantity_change": 1},
+                {"stock_name": "PiloteCo", "quantity_change": 1},
+            ],
+        }
+        sock.sendall(json.dumps(request).encode("utf-8"))
+        sock.recv(4096)
+
+
 def run_all_tests():
     try:
         test_lookup_stock()
         test_lookup_nonexistent_stock()
         test_update_quantity()
         test_insufficient_quantity()
+        test_lookup_many()
+        test_changes_since()
+        test_update_many()
         print("\n✓ All catalog service tests passed!")
     except AssertionError as e:
         print(f"\n✗ Test failed: {e}")
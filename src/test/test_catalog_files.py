@@ -0,0 +1,197 @@
+import contextlib
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "catalog"))
+
+import catalog
+
+"""
+Tests for the catalog's files (catalog.csv, catalog.wal, catalog.snap). They
+run on their own in a temp directory, no services needed:
+   - replaying the write-ahead log after a crash in the middle of a checkpoint
+   - switching between the csv and the binary snapshot (CATALOG_TABLE=mmap)
+   - the array and mmap stock tables
+"""
+
+
+def fresh_catalog(table_mode="dict", durability_mode="csv"):
+    # forget what is in memory, as a restart would
+    if catalog.wal_handle is not None:
+        catalog.wal_handle.close()
+    if isinstance(catalog.stock_check, catalog.MmapStockTable):
+        catalog.stock_check.close()
+    catalog.table_mode = table_mode
+    catalog.durability_mode = durability_mode
+    catalog.stock_check = {}
+    catalog.catalog_version = 0
+    catalog.wal_handle = None
+    catalog.wal_records = 0
+    catalog.wal_seq = 0
+    catalog.durable_seq = 0
+
+
+@contextlib.contextmanager
+def in_temp_dir():
+    # the catalog keeps its files under data/ in the working directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            fresh_catalog()
+            os.chdir(cwd)
+
+
+def quantity(stock_name):
+    return catalog.stock_check[stock_name]["quantity"]
+
+
+def test_wal_replay_after_interrupted_checkpoint():
+    print("\nTest: A crash in the middle of a checkpoint loses no trades")
+    with in_temp_dir():
+        fresh_catalog(durability_mode="wal")
+        catalog.load_stocks()
+        catalog.change_quantity("BoarCo", -10)
+        catalog.change_quantity("GameStart", -3)
+
+        # the checkpoint moves the log aside, then dies before the csv is written
+        save_stocks = catalog.save_stocks
+        catalog.save_stocks = lambda snapshot=None: False
+        try:
+            catalog.checkpoint_stocks()
+        finally:
+            catalog.save_stocks = save_stocks
+        assert os.path.exists(catalog.wal_file + ".old")
+        catalog.change_quantity("BoarCo", -5)  # goes to a new live log
+        with open(catalog.wal_file, "a") as f:
+            f.write('[["BoarCo", 0')  # and the crash tears the next record
+
+        fresh_catalog(durability_mode="wal")
+        catalog.load_stocks()
+        assert quantity("BoarCo") == 85, "both logs should be replayed, in order"
+        assert quantity("GameStart") == 97
+        assert catalog.catalog_version == 3
+
+        # trades after the restart survive the next restart too
+        catalog.change_quantity("BoarCo", -1)
+        fresh_catalog(durability_mode="wal")
+        catalog.load_stocks()
+        assert quantity("BoarCo") == 84, "a record after the torn one was lost"
+
+        # a checkpoint that finishes folds everything into the csv
+        catalog.change_quantity("BoarCo", -1)
+        catalog.checkpoint_stocks()
+        assert not os.path.exists(catalog.wal_file + ".old")
+        os.remove(catalog.wal_file)
+        fresh_catalog()
+        catalog.load_stocks()
+        assert quantity("BoarCo") == 83
+        assert catalog.stock_check["BoarCo"]["version"] == 5
+    print("✓ Interrupted checkpoint test passed")
+
+
+def test_mode_switch_keeps_trades():
+    print("\nTest: Switching table modes starts from the newer file")
+    with in_temp_dir():
+        fresh_catalog("dict")
+        catalog.load_stocks()
+        catalog.change_quantity("BoarCo", -10)
+
+        fresh_catalog("mmap")
+        catalog.load_stocks()
+        assert isinstance(catalog.stock_check, catalog.MmapStockTable)
+        assert quantity("BoarCo") == 90, "the snapshot should start from the csv"
+        catalog.change_quantity("BoarCo", -5)  # only the snapshot has this
+
+        fresh_catalog("array")
+        catalog.load_stocks()
+        assert isinstance(catalog.stock_check, catalog.ArrayStockTable)
+        assert quantity("BoarCo") == 85, "trades made in mmap mode were lost"
+        assert catalog.catalog_version == 2
+        catalog.change_quantity("BoarCo", -1)
+
+        # a snapshot touched after the csv but holding older versions loses
+        os.utime(catalog.snapshot_file)
+        fresh_catalog("dict")
+        catalog.load_stocks()
+        assert quantity("BoarCo") == 84, "a stale snapshot replaced the csv"
+        catalog.change_quantity("BoarCo", -1)
+
+        fresh_catalog("mmap")
+        catalog.load_stocks()
+        assert quantity("BoarCo") == 83
+        assert catalog.stock_check["BoarCo"]["version"] == 4
+    print("✓ Mode switch test passed")
+
+
+def test_array_table():
+    print("\nTest: Array stock table")
+    table = catalog.ArrayStockTable()
+    table.add("BoarCo", 7.11, 100)
+    table.add("GameStart", 15.99, 50, version=3)
+    table["BoarCo"] = {"price": 7.11, "quantity": 90, "version": 4}
+    table["MenhirCo"] = {"price": 20.0, "quantity": 25}
+    assert table["BoarCo"] == {"price": 7.11, "quantity": 90, "version": 4}
+    assert table.get("Nope") is None
+    assert "MenhirCo" in table and "Nope" not in table
+    assert list(table) == ["BoarCo", "GameStart", "MenhirCo"]
+    assert table.max_version() == 4
+
+    copy = table.copy()
+    table["BoarCo"] = {"price": 7.11, "quantity": 80, "version": 5}
+    table.add("CaesarTech", 1.0, 10)
+    assert copy["BoarCo"]["quantity"] == 90, "the copy changed with the table"
+    assert len(copy) == 3 and len(table) == 4
+    assert dict(copy.items())["GameStart"] == {"price": 15.99, "quantity": 50, "version": 3}
+    print("✓ Array table test passed")
+
+
+def test_mmap_table():
+    print("\nTest: Mmap stock table")
+    with in_temp_dir():
+        catalog.write_snapshot(
+            catalog.snapshot_file,
+            [
+                ("GameStart", {"price": 15.99, "quantity": 50, "version": 3}),
+                ("BoarCo", {"price": 7.11, "quantity": 100, "version": 1}),
+            ],
+        )
+        table = catalog.MmapStockTable(catalog.snapshot_file)
+        assert list(table) == ["BoarCo", "GameStart"], "rows should be sorted by name"
+        assert table["GameStart"] == {"price": 15.99, "quantity": 50, "version": 3}
+        assert table.get("Nope") is None and "Nope" not in table
+        assert catalog.file_version(catalog.snapshot_file) == 3
+
+        table["BoarCo"] = {"price": 7.11, "quantity": 90, "version": 4}
+        table["MenhirCo"] = {"price": 20.0, "quantity": 25, "version": 5}
+        assert len(table) == 3 and "MenhirCo" in table
+        assert table.max_version() == 5
+
+        copy = table.copy()
+        table["BoarCo"] = {"price": 7.11, "quantity": 80, "version": 6}
+        table["CaesarTech"] = {"price": 1.0, "quantity": 10, "version": 7}
+        assert copy["BoarCo"]["quantity"] == 90, "the copy changed with the table"
+        assert len(copy) == 3 and len(table) == 4
+        assert [name for name, details in copy.items()] == ["BoarCo", "GameStart", "MenhirCo"]
+        table.close()
+    print("✓ Mmap table test passed")
+
+
+def run_all_tests():
+    try:
+        test_wal_replay_after_interrupted_checkpoint()
+        test_mode_switch_keeps_trades()
+        test_array_table()
+        test_mmap_table()
+        print("\n✓ All catalog file tests passed!")
+    except AssertionError as e:
+        print(f"\n✗ Test failed: {e}")
+    except Exception as e:
+        print(f"\n✗ Error during testing: {e}")
+
+
+if __name__ == "__main__":
+    run_all_tests()
@@ -63,12 +63,87 @@ def test_lookup_nonexistent_order():
     print("✓ Non-existent order lookup test passed")
 
 
+def test_batch_stock_lookup():
+    print("\nTest: Batched stock lookup")
+    response = requests.get(f"{BASE_URL}/stocks?names=GameStart,BoarCo,NonExistentStock")
+    print(f"Response: {response.json()}")
+    assert response.status_code == 200
+    assert [entry["name"] for entry in response.json()["data"]] == ["GameStart", "BoarCo"]
+    assert response.json()["errors"]["NonExistentStock"]["code"] == 404
+    print("✓ Batched stock lookup test passed")
+
+
+def test_batch_order_creation():
+    print("\nTest: Batch order creation")
+    orders = [
+        {"name": "BoarCo", "quantity": 1, "type": "buy"},
+        {"name": "NonExistentStock", "quantity": 1, "type": "buy"},
+        {"name": "BoarCo", "quantity": 1, "type": "sell"},
+    ]
+    response = requests.post(f"{BASE_URL}/orders/batch", json={"orders": orders})
+    print(f"Response: {response.json()}")
+    assert response.status_code == 200
+    results = response.json()["data"]["results"]
+    assert len(results) == 3
+    assert results[1]["error"]["code"] == 404
+    # the filled orders get consecutive transaction numbers
+    assert results[2]["transaction_number"] == results[0]["transaction_number"] + 1
+    print("✓ Batch order creation test passed")
+
+
+def test_order_idempotency_key():
+    print("\nTest: Retrying an order with the same idempotency key")
+    order = {"name": "BoarCo", "quantity": 1, "type": "buy"}
+    headers = {"Idempotency-Key": f"frontend-test-{time.time()}"}
+    first = requests.post(f"{BASE_URL}/orders", json=order, headers=headers)
+    retry = requests.post(f"{BASE_URL}/orders", json=order, headers=headers)
+    print(f"First: {first.json()}, retry: {retry.json()}")
+    assert first.status_code == 200
+    assert retry.json() == first.json()
+    print("✓ Order idempotency key test passed")
+
+
+def test_order_query():
+    print("\nTest: Querying orders by stock and time")
+    start = time.time()
+    order = {"name": "BoarCo", "quantity": 1, "type": "buy"}
+    placed = requests.post(f"{BASE_URL}/orders", json=order).json()["data"]
+    response = requests.get(f"{BASE_URL}/orders", params={"stock": "BoarCo", "from": start})
+    print(f"Response: {response.json()}")
+    assert response.status_code == 200
+    orders = response.json()["data"]
+    assert [o["number"] for o in orders] == [placed["transaction_number"]]
+    assert orders[0]["name"] == "BoarCo"
+    response = requests.get(f"{BASE_URL}/orders", params={"limit": "lots"})
+    assert response.status_code == 400
+    print("✓ Order query test passed")
+
+
+def test_order_stats():
+    print("\nTest: Order stats")
+    requests.post(f"{BASE_URL}/orders", json={"name": "BoarCo", "quantity": 1, "type": "buy"})
+    response = requests.get(f"{BASE_URL}/orders/stats", params={"stock": "BoarCo"})
+    print(f"Response: {response.json()}")
+    assert response.status_code == 200
+    stats = response.json()["data"]["stocks"]["BoarCo"]
+    assert stats["orders"] >= 1 and stats["bought"] >= 1
+    assert stats["net_flow"] == stats["bought"] - stats["sold"]
+    response = requests.get(f"{BASE_URL}/orders/stats", params={"minutes": "recent"})
+    assert response.status_code == 400
+    print("✓ Order stats test passed")
+
+
 def run_all_tests():
     try:
         test_stock_lookup()
+        test_batch_stock_lookup()
         order_num = test_order_creation()
         test_order_lookup(order_num)
         test_lookup_nonexistent_order()
+        test_batch_order_creation()
+        test_order_idempotency_key()
+        test_order_query()
+        test_order_stats()
         print("\n✓ All frontend service tests passed!")
     except AssertionError as e:
         print(f"\n✗ Test failed: {e}")
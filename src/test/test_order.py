@@ -4,6 +4,7 @@ AI: ChatGPT 4o - used in Lab 2
 """
 
 import socket
+import struct
 import json
 import time
 import os
@@ -12,9 +13,9 @@ ORDER_HOST = "localhost"
 ORDER_PORT = 7777
 
 
-def send_request(request):
+def send_request(request, port=ORDER_PORT):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-        sock.connect((ORDER_HOST, ORDER_PORT))
+        sock.connect((ORDER_HOST, port))
         sock.sendall(json.dumps(request).encode("utf-8"))
         response = sock.recv(4096)
         return json.loads(response.decode("utf-8"))
@@ -65,11 +66,199 @@ def test_lookup_nonexistent_order_service():
     print("✓ Non-existent order lookup test passed")
 
 
+def test_replication_to_followers():
+    print("\nTest: Trades reach the followers over the replication streams")
+    trade_request = {
+        "action": "trade",
+        "stock_name": "GameStart",
+        "quantity": 1,
+        "order_type": "sell",
+    }
+    trade_response = send_request(trade_request)
+    assert trade_response["status"] == "success"
+    order_num = trade_response["data"]["transaction_number"]
+
+    # Followers acknowledge asynchronously, give them a moment
+    for _ in range(20):
+        status = send_request({"action": "replication_status"})
+        if all(f["acked"] >= order_num for f in status["followers"]):
+            break
+        time.sleep(0.1)
+    print(f"Replication status: {status}")
+    assert status["status"] == "success"
+    for follower in status["followers"]:
+        assert follower["connected"]
+        assert follower["acked"] >= order_num
+        lookup = send_request({"action": "lookup", "order_number": order_num}, follower["port"])
+        assert lookup["status"] == "success"
+        assert lookup["data"]["type"] == "sell"
+    print("✓ Replication test passed")
+
+
+def test_trade_consistency_levels():
+    print("\nTest: Trades at each consistency level")
+    for level in ["async", "quorum", "all"]:
+        trade_request = {
+            "action": "trade",
+            "stock_name": "GameStart",
+            "quantity": 1,
+            "order_type": "buy" if level != "quorum" else "sell",
+            "consistency": level,
+        }
+        response = send_request(trade_request)
+        print(f"{level}: {response}")
+        assert response["status"] == "success"
+
+    trade_request["consistency"] = "eventually"
+    response = send_request(trade_request)
+    print(f"Unknown level: {response}")
+    assert response["status"] == "error"
+    assert response["error"]["code"] == 400
+    print("✓ Consistency level test passed")
+
+
+def test_trade_batch():
+    print("\nTest: Batch of trades")
+    request = {
+        "action": "trade_batch",
+        "orders": [
+            {"stock_name": "MenhirCo", "quantity": 1, "order_type": "buy"},
+            {"stock_name": "MenhirCo", "quantity": 1000000, "order_type": "buy"},
+            {"stock_name": "MenhirCo", "quantity": 0, "order_type": "buy"},
+            {"stock_name": "MenhirCo", "quantity": 1, "order_type": "sell"},
+        ],
+    }
+    response = send_request(request)
+    print(f"Response: {response}")
+    assert response["status"] == "success"
+    results = response["data"]["results"]
+    assert results[1]["error"]["message"] == "insufficient quantity"
+    assert results[2]["error"]["code"] == 400
+    first = results[0]["transaction_number"]
+    assert results[3]["transaction_number"] == first + 1
+
+    lookup = send_request({"action": "lookup", "order_number": first + 1})
+    assert lookup["data"]["type"] == "sell"
+    print("✓ Batch trade test passed")
+
+
+def test_idempotent_trade():
+    print("\nTest: A repeated idempotency key trades only once")
+    trade_request = {
+        "action": "trade",
+        "stock_name": "GameStart",
+        "quantity": 1,
+        "order_type": "sell",
+        "idempotency_key": f"test-{time.time()}",
+    }
+    first = send_request(trade_request)
+    assert first["status"] == "success"
+    retry = send_request(trade_request)
+    print(f"First: {first}, retry: {retry}")
+    assert retry == first
+
+    # the key is replicated with the order, so a retry after a failover to a
+    # follower still gets the original result
+    order_num = first["data"]["transaction_number"]
+    for _ in range(20):
+        status = send_request({"action": "replication_status"})
+        if all(f["acked"] >= order_num for f in status["followers"]):
+            break
+        time.sleep(0.1)
+    for follower in status["followers"]:
+        assert send_request(trade_request, follower["port"]) == first
+    print("✓ Idempotent trade test passed")
+
+
+def query_orders(request, port=ORDER_PORT):
+    # query_orders answers with length-prefixed frames until one says done
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.connect((ORDER_HOST, port))
+        sock.sendall(json.dumps(dict(request, action="query_orders")).encode("utf-8"))
+        file = sock.makefile("rb")
+        orders = []
+        while True:
+            (size,) = struct.unpack(">I", file.read(4))
+            frame = json.loads(file.read(size).decode("utf-8"))
+            if "orders" not in frame:
+                return frame
+            orders += frame["orders"]
+            if frame.get("done"):
+                return orders
+
+
+def test_query_orders():
+    print("\nTest: Query orders by stock and time")
+    start = time.time()
+    numbers = []
+    for order_type in ["buy", "sell", "buy"]:
+        response = send_request(
+            {"action": "trade", "stock_name": "MenhirCo", "quantity": 1, "order_type": order_type}
+        )
+        assert response["status"] == "success"
+        numbers.append(response["data"]["transaction_number"])
+    send_request({"action": "trade", "stock_name": "GameStart", "quantity": 1, "order_type": "buy"})
+
+    orders = query_orders({"stock_name": "MenhirCo", "from": start})
+    print(f"Orders: {orders}")
+    assert [order["number"] for order in orders] == numbers
+    assert all(order["name"] == "MenhirCo" for order in orders)
+    assert [order["type"] for order in orders] == ["buy", "sell", "buy"]
+
+    limited = query_orders({"stock_name": "MenhirCo", "from": start, "limit": 2})
+    assert [order["number"] for order in limited] == numbers[:2]
+    assert query_orders({"stock_name": "MenhirCo", "from": time.time() + 60}) == []
+    assert query_orders({"limit": "many"})["error"]["code"] == 400
+    print("✓ Order query test passed")
+
+
+def test_trade_stats():
+    print("\nTest: Per-stock trade stats")
+    before = send_request({"action": "stats", "stock_name": "GameStart"})
+    assert before["status"] == "success"
+    totals = before["data"]["stocks"].get("GameStart", {"orders": 0, "bought": 0, "sold": 0})
+    for order_type, quantity in [("buy", 3), ("sell", 1)]:
+        response = send_request(
+            {"action": "trade", "stock_name": "GameStart", "quantity": quantity, "order_type": order_type}
+        )
+        assert response["status"] == "success"
+
+    after = send_request({"action": "stats", "stock_name": "GameStart", "minutes": 5})
+    print(f"Stats: {after}")
+    stats = after["data"]["stocks"]["GameStart"]
+    assert stats["orders"] == totals["orders"] + 2
+    assert stats["bought"] == totals["bought"] + 3
+    assert stats["sold"] == totals["sold"] + 1
+    assert stats["net_flow"] == stats["bought"] - stats["sold"]
+    assert sum(minute["orders"] for minute in stats["minutes"]) >= 2
+    assert list(after["data"]["stocks"]) == ["GameStart"]
+    assert send_request({"action": "stats", "minutes": -1})["error"]["code"] == 400
+    print("✓ Trade stats test passed")
+
+
+def test_invalid_trade():
+    print("\nTest: Trades with an unknown order type or bad quantity are refused")
+    for order_type, quantity in [("BUY", 1), ("hold", 1), ("buy", 0), ("buy", "1")]:
+        response = send_request(
+            {"action": "trade", "stock_name": "GameStart", "quantity": quantity, "order_type": order_type}
+        )
+        assert response["status"] == "error"
+        assert response["error"]["code"] == 400
+    print("✓ Invalid trade test passed")
+
+
 def run_all_tests():
     try:
         test_ping_service()
         test_trade_and_lookup_function()
         test_lookup_nonexistent_order_service()
+        test_replication_to_followers()
+        test_trade_consistency_levels()
+        test_trade_batch()
+        test_invalid_trade()
+        test_idempotent_trade()
+        test_query_orders()
+        test_trade_stats()
         print("\n✓ All order service tests passed!")
     except AssertionError as e:
         print(f"\n✗ Test failed: {e}")
@@ -0,0 +1,271 @@
+import contextlib
+import os
+import socket
+import sys
+import tempfile
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "order"))
+
+import order
+
+"""
+Tests for the order service's log files. They run on their own in a temp
+directory, no services needed:
+   - resuming the csv log from its checkpoint, and falling back to a full scan
+     when the checkpoint doesn't match the log
+   - installing a peer's snapshot and then the orders it logged after it,
+     with both storages
+"""
+
+
+def make_orders(first, count, stock_prefix="Stock"):
+    return [
+        (n, f"{stock_prefix}{n % 3}", "buy" if n % 2 else "sell", n + 1, 1000.0 + n)
+        for n in range(first, first + count)
+    ]
+
+
+started = False  # whether restart() has started the order log yet
+
+
+def wait_for_indexing():
+    # the history is indexed in the background; let it finish before the
+    # files it reads go away
+    if not started:
+        return
+    if order.order_log is None:
+        order.index_ready.wait(5)  # the csv log's offsets
+    order.order_queries.ready.wait(5)
+    order.order_stats.ready.wait(5)
+
+
+def restart(storage="csv", replica=0):
+    # forget what is in memory and start up again from the files, as a
+    # restarted replica would
+    global started
+    wait_for_indexing()
+    if order.order_handle is not None:
+        order.order_handle.close()
+    if order.order_log is not None:
+        order.order_log.close()
+    order.order_handle = None
+    order.order_log = None
+    order.order_storage = storage
+    order.order_file = f"data/orders{replica}.csv"
+    order.order_log_dir = f"data/orders{replica}"
+    order.checkpoint_file = f"data/orders{replica}.ckpt"
+    order.order_index = {}
+    order.index_ready = threading.Event()
+    order.last_logged = -1
+    order.unchecked_orders = 0
+    order.next_transaction = 0
+    os.makedirs("data", exist_ok=True)
+    order.init_txn_ctr()
+    started = True
+
+
+@contextlib.contextmanager
+def in_temp_dir():
+    # the order service keeps its files under data/ in the working directory
+    cwd = os.getcwd()
+    checkpoint_every = order.checkpoint_every
+    segment_bytes = order.segment_bytes
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            restart()  # lets go of the files in the temp dir
+            order.checkpoint_every = checkpoint_every
+            order.segment_bytes = segment_bytes
+            os.chdir(cwd)
+
+
+def logged_numbers():
+    return [record["transaction_number"] for record in order.iter_orders_after(-1)]
+
+
+def test_checkpoint_resume():
+    print("\nTest: A restart resumes from the checkpoint")
+    with in_temp_dir():
+        order.checkpoint_every = 10
+        restart()
+        for first in range(0, 25, 5):
+            order.log_orders(make_orders(first, 5))
+        checkpoint = order.load_checkpoint()
+        assert checkpoint is not None and checkpoint["last_transaction"] == 19
+
+        restart()
+        assert order.next_transaction == 25
+        order.index_ready.wait(5)
+        assert sorted(order.order_index) == list(range(25))
+        assert order.lookup_order_record(3)["quantity"] == 4
+        assert order.lookup_order_record(24)["stock_name"] == "Stock0"
+    print("✓ Checkpoint resume test passed")
+
+
+def test_checkpoint_mismatch():
+    print("\nTest: A checkpoint that doesn't match the log falls back to a full scan")
+    with in_temp_dir():
+        order.checkpoint_every = 10
+        restart()
+        for first in range(0, 25, 5):
+            order.log_orders(make_orders(first, 5))
+        restart()
+
+        # rewrite the row the checkpoint ends on, keeping its length
+        with open(order.order_file, "rb") as f:
+            data = f.read()
+        row = b"\n19,Stock1,buy,20,"
+        assert row in data
+        with open(order.order_file, "wb") as f:
+            f.write(data.replace(row, b"\n19,Stock1,buy,21,"))
+        assert order.load_checkpoint() is None, "the checkpoint's CRC should not match"
+
+        restart()
+        assert order.index_ready.is_set(), "a full scan indexes everything up front"
+        assert sorted(order.order_index) == list(range(25))
+        assert order.lookup_order_record(19)["quantity"] == 21
+        checkpoint = order.load_checkpoint()
+        assert checkpoint is not None and checkpoint["last_transaction"] == 24
+
+        # a log cut short before the checkpoint is scanned in full too
+        os.truncate(order.order_file, order.order_index[12])
+        restart()
+        assert logged_numbers() == list(range(12))
+        assert order.next_transaction == 12
+    print("✓ Checkpoint mismatch test passed")
+
+
+def take_snapshot(staging):
+    # what install_snapshot_from receives from this replica's send_snapshot
+    sender, receiver = socket.socketpair()
+    thread = threading.Thread(target=order.send_snapshot, args=(sender, order.order_storage))
+    thread.start()
+    header = order.recv_frame(receiver)
+    if order.order_log is None:
+        for file in header["files"]:
+            order.recv_into_file(receiver, staging, file["size"])
+    else:
+        os.makedirs(staging)
+        for file in header["files"]:
+            order.recv_into_file(receiver, os.path.join(staging, file["name"]), file["size"])
+    thread.join()
+    sender.close()
+    receiver.close()
+    return header
+
+
+def stream_tail(after):
+    # the frames this replica's stream_orders sends a peer that is at after
+    sender, receiver = socket.socketpair()
+    thread = threading.Thread(target=order.stream_orders, args=(sender, after, 7))
+    thread.start()
+    frames = []
+    while not frames or not frames[-1].get("done"):
+        frames.append(order.recv_frame(receiver))
+    thread.join()
+    sender.close()
+    receiver.close()
+    return frames
+
+
+def check_install_then_tail(storage):
+    with in_temp_dir():
+        order.segment_bytes = 512
+        # the peer, replica 1
+        restart(storage, replica=1)
+        for first in range(0, 60, 10):
+            order.log_orders(make_orders(first, 10))
+        staging = (order.order_file if storage == "csv" else order.order_log_dir) + ".install"
+        staging = staging.replace("orders1", "orders0")
+        header = take_snapshot(staging)
+        assert header["last_transaction"] == 59
+        order.log_orders(make_orders(60, 20))
+        frames = stream_tail(header["last_transaction"])
+        expected = list(order.iter_orders_after(-1))
+        if storage == "segments":
+            assert len(order.order_log.segments) > 1, "small segments should have rolled over"
+
+        # this replica, 0, has a log of its own that the snapshot replaces
+        restart(storage, replica=0)
+        order.log_orders(make_orders(0, 5, "Stale"))
+        order.install_snapshot(staging)
+        assert order.last_logged_transaction() == 59
+        for frame in frames:
+            order.apply_orders(frame["orders"])
+        assert list(order.iter_orders_after(-1)) == expected
+        assert order.lookup_order_record(42) == expected[42]
+        assert order.next_transaction == 80
+
+        restart(storage, replica=0)
+        assert list(order.iter_orders_after(-1)) == expected
+        assert order.next_transaction == 80
+
+
+def test_install_then_tail_csv():
+    print("\nTest: Snapshot install and tail stream (csv)")
+    check_install_then_tail("csv")
+    print("✓ Csv snapshot install test passed")
+
+
+def test_install_then_tail_segments():
+    print("\nTest: Snapshot install and tail stream (segments)")
+    check_install_then_tail("segments")
+    print("✓ Segments snapshot install test passed")
+
+
+def test_install_during_history_scan():
+    print("\nTest: A history scan of a replaced log is dropped")
+    with in_temp_dir():
+        order.checkpoint_every = 10
+        restart()
+        for first in range(0, 25, 5):
+            order.log_orders(make_orders(first, 5))
+        staging = order.order_file + ".install"
+        with open(staging, "w") as f:
+            f.write("transaction_number,stock_name,order_type,quantity,timestamp\n")
+            f.writelines(f"{n},NewCo,sell,2,{n}.0\n" for n in range(10))
+
+        # hold the background history scan until the snapshot is in
+        scan_order_log = order.scan_order_log
+        scanned = threading.Event()
+
+        def held_scan(start=0, end=None):
+            index = scan_order_log(start, end)
+            if end is not None:
+                scanned.wait(5)
+            return index
+
+        order.scan_order_log = held_scan
+        try:
+            restart()
+            order.install_snapshot(staging)
+            scanned.set()
+            for thread in threading.enumerate():
+                if "index_history" in thread.name:
+                    thread.join(5)
+        finally:
+            order.scan_order_log = scan_order_log
+        assert sorted(order.order_index) == list(range(10)), "old offsets were merged in"
+        assert order.lookup_order_record(3)["stock_name"] == "NewCo"
+    print("✓ History scan test passed")
+
+
+def run_all_tests():
+    try:
+        test_checkpoint_resume()
+        test_checkpoint_mismatch()
+        test_install_then_tail_csv()
+        test_install_then_tail_segments()
+        test_install_during_history_scan()
+        print("\n✓ All order log tests passed!")
+    except AssertionError as e:
+        print(f"\n✗ Test failed: {e}")
+    except Exception as e:
+        print(f"\n✗ Error during testing: {e}")
+
+
+if __name__ == "__main__":
+    run_all_tests()
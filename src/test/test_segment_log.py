@@ -0,0 +1,139 @@
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "order"))
+
+from segment_log import SegmentLog, RECORD_HEADER
+
+"""
+Tests for the segmented order log (ORDER_STORAGE=segments). They run on their
+own in a temp directory, no services needed:
+   - appending, lookups and scans across segment rollovers
+   - recovery on reopen, including a torn last record
+   - records that are already logged or can't be packed
+"""
+
+
+def make_orders(first, count):
+    return [
+        (n, f"Stock{n % 3}", "buy" if n % 2 else "sell", n + 1, 1000.0 + n)
+        for n in range(first, first + count)
+    ]
+
+
+def test_append_and_lookup():
+    print("\nTest: Append, lookup and scan across segments")
+    with tempfile.TemporaryDirectory() as directory:
+        log = SegmentLog(directory, segment_bytes=200, index_interval=64)
+        log.append(make_orders(0, 50))
+        assert log.last_transaction == 49
+        assert len(log.segments) > 1, "small segments should have rolled over"
+
+        record = log.lookup(17)
+        assert record == {
+            "transaction_number": 17,
+            "stock_name": "Stock2",
+            "order_type": "buy",
+            "quantity": 18,
+            "timestamp": 1017.0,
+        }
+        assert log.lookup(50) is None
+        assert [r["transaction_number"] for r in log.iter_from(45)] == list(range(45, 50))
+        assert [r["transaction_number"] for r in log.iter_from(0)] == list(range(50))
+        log.close()
+    print("✓ Append and lookup test passed")
+
+
+def test_reopen_recovers():
+    print("\nTest: Reopening picks up where the log ended")
+    with tempfile.TemporaryDirectory() as directory:
+        log = SegmentLog(directory, segment_bytes=200, index_interval=64)
+        log.append(make_orders(0, 30))
+        log.close()
+
+        log = SegmentLog(directory, segment_bytes=200, index_interval=64)
+        assert log.last_transaction == 29
+        log.append(make_orders(30, 10))
+        assert [r["transaction_number"] for r in log.iter_from(0)] == list(range(40))
+        log.close()
+    print("✓ Reopen test passed")
+
+
+def test_torn_record_truncated():
+    print("\nTest: A record cut short by a crash is dropped on reopen")
+    with tempfile.TemporaryDirectory() as directory:
+        log = SegmentLog(directory)
+        log.append(make_orders(0, 5))
+        log.close()
+        segment = log.path(log.segments[-1], ".log")
+        size = os.path.getsize(segment)
+        with open(segment, "ab") as f:
+            f.write(RECORD_HEADER.pack(5, 1005.0, 0, 6, 10) + b"Stoc")  # name cut short
+
+        log = SegmentLog(directory)
+        assert log.last_transaction == 4
+        assert os.path.getsize(segment) == size
+        log.append(make_orders(5, 1))
+        assert log.lookup(5)["stock_name"] == "Stock2"
+        log.close()
+    print("✓ Torn record test passed")
+
+
+def test_empty_segment_removed():
+    print("\nTest: A segment rolled over but never written is removed on reopen")
+    with tempfile.TemporaryDirectory() as directory:
+        log = SegmentLog(directory)
+        log.append(make_orders(0, 3))
+        log.close()
+        open(log.path(3, ".log"), "wb").close()
+
+        log = SegmentLog(directory)
+        assert log.segments == [0]
+        assert log.last_transaction == 2
+        assert not os.path.exists(log.path(3, ".log"))
+        log.close()
+    print("✓ Empty segment test passed")
+
+
+def test_skips_and_bad_records():
+    print("\nTest: Old transactions are skipped and bad records leave no trace")
+    with tempfile.TemporaryDirectory() as directory:
+        log = SegmentLog(directory, index_interval=1)
+        log.append(make_orders(0, 3))
+        log.append(make_orders(1, 3))  # 1 and 2 are already logged
+        assert [r["transaction_number"] for r in log.iter_from(0)] == [0, 1, 2, 3]
+
+        try:
+            log.append([(4, "BoarCo", "BUY", 1, 1004.0)])
+            assert False, "an unknown order type should not be packed"
+        except ValueError:
+            pass
+        log.append(make_orders(4, 1))
+        assert log.lookup(4)["order_type"] == "sell"
+        assert [r["transaction_number"] for r in log.iter_from(0)] == [0, 1, 2, 3, 4]
+        log.close()
+
+        log = SegmentLog(directory, index_interval=1)
+        assert log.last_transaction == 4
+        assert log.lookup(4)["quantity"] == 5
+        log.close()
+    print("✓ Skip and bad record test passed")
+
+
+def run_all_tests():
+    try:
+        test_append_and_lookup()
+        test_reopen_recovers()
+        test_torn_record_truncated()
+        test_empty_segment_removed()
+        test_skips_and_bad_records()
+        print("\n✓ All segment log tests passed!")
+    except AssertionError as e:
+        print(f"\n✗ Test failed: {e}")
+    except Exception as e:
+        print(f"\n✗ Error during testing: {e}")
+
+
+if __name__ == "__main__":
+    run_all_tests()